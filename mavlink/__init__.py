@@ -21,12 +21,105 @@
 
 # Common Messages
 HEARTBEAT = 0
+SYS_STATUS = 1
+SYSTEM_TIME = 2
+PARAM_VALUE = 22
+GPS_RAW_INT = 24
+RAW_IMU = 27
+SCALED_PRESSURE = 29
 GLOBAL_POSITION_INT = 33
+SERVO_OUTPUT_RAW = 36
+MISSION_CURRENT = 42
+NAV_CONTROLLER_OUTPUT = 62
+RC_CHANNELS = 65
+REQUEST_DATA_STREAM = 66
+VFR_HUD = 74
+COMMAND_LONG = 76
+COMMAND_ACK = 77
+TIMESYNC = 111
+BATTERY_STATUS = 147
+EKF_STATUS_REPORT = 193
+VIBRATION = 241
+HOME_POSITION = 242
+DEBUG_VECT = 250
+NAMED_VALUE_FLOAT = 251
 STATUSTEXT = 253
+TUNNEL = 385
 ATTITUDE = 30
 AHRS2 = 178
 AHRS3 = 182
 
+# CRC_EXTRA seeds, keyed by message id. frames with ids missing here cannot be validated,
+# so the commonly streamed ones are listed even if nothing decodes them
+CRC_EXTRA = {
+    HEARTBEAT: 50,
+    SYS_STATUS: 124,
+    SYSTEM_TIME: 137,
+    PARAM_VALUE: 220,
+    GPS_RAW_INT: 24,
+    RAW_IMU: 144,
+    SCALED_PRESSURE: 115,
+    ATTITUDE: 39,
+    GLOBAL_POSITION_INT: 104,
+    SERVO_OUTPUT_RAW: 222,
+    MISSION_CURRENT: 28,
+    NAV_CONTROLLER_OUTPUT: 183,
+    RC_CHANNELS: 118,
+    REQUEST_DATA_STREAM: 148,
+    VFR_HUD: 20,
+    COMMAND_LONG: 152,
+    COMMAND_ACK: 143,
+    TIMESYNC: 34,
+    BATTERY_STATUS: 154,
+    AHRS2: 47,
+    AHRS3: 229,
+    EKF_STATUS_REPORT: 71,
+    VIBRATION: 90,
+    HOME_POSITION: 104,
+    DEBUG_VECT: 49,
+    NAMED_VALUE_FLOAT: 170,
+    STATUSTEXT: 83,
+    TUNNEL: 147,
+}
+
+# full (untruncated) payload lengths. MAVLink v2 strips trailing zero bytes on the wire
+PAYLOAD_LEN = {
+    HEARTBEAT: 9,
+    ATTITUDE: 28,
+    GLOBAL_POSITION_INT: 28,
+    AHRS2: 24,
+    AHRS3: 40,
+    STATUSTEXT: 51,
+    REQUEST_DATA_STREAM: 6,
+    COMMAND_LONG: 33,
+    DEBUG_VECT: 30,
+    NAMED_VALUE_FLOAT: 18,
+    TUNNEL: 133,
+}
+
+# Commands
+MAV_CMD_SET_MESSAGE_INTERVAL = 511
+
+# Data streams, for autopilots without SET_MESSAGE_INTERVAL
+MAV_DATA_STREAM_ALL = 0
+MAV_DATA_STREAM_RAW_SENSORS = 1
+MAV_DATA_STREAM_EXTENDED_STATUS = 2
+MAV_DATA_STREAM_RC_CHANNELS = 3
+MAV_DATA_STREAM_RAW_CONTROLLER = 4
+MAV_DATA_STREAM_POSITION = 6
+MAV_DATA_STREAM_EXTRA1 = 10
+MAV_DATA_STREAM_EXTRA2 = 11
+MAV_DATA_STREAM_EXTRA3 = 12
+
+# TUNNEL payload types above 32767 are free for local use
+MPSP_TUNNEL_PAYLOAD_TYPE = 32768
+
+# our own identity on the link
+MAV_COMP_ID_ONBOARD_COMPUTER = 191
+
+# HEARTBEAT autopilot field of GCSs, companions and other non-flight controllers
+MAV_AUTOPILOT_INVALID = 8
+
 # ArdupilotMega Messages
 # = 178
 # = 182
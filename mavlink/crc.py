@@ -0,0 +1,53 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from array import array
+# ============= local library imports  ==========================
+
+
+def _make_table():
+    # X.25 / CRC-16-MCRF4XX, reflected polynomial 0x1021
+    t = array('H', bytes(512))
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            if c & 1:
+                c = (c >> 1) ^ 0x8408
+            else:
+                c >>= 1
+        t[i] = c
+    return t
+
+
+X25_TABLE = _make_table()
+
+
+def x25_crc(buf, start, end, crc=0xFFFF):
+    """
+    accumulate the X.25 checksum of buf[start:end] without slicing buf
+    """
+    t = X25_TABLE
+    for i in range(start, end):
+        crc = (crc >> 8) ^ t[(crc ^ buf[i]) & 0xFF]
+    return crc
+
+
+def x25_accumulate(byte, crc):
+    return (crc >> 8) ^ X25_TABLE[(crc ^ byte) & 0xFF]
+
+# ============= EOF =============================================
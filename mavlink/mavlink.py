@@ -1,85 +1,760 @@
 import struct
-from pyb import UART, millis, delay
+from pyb import UART, Timer, millis, delay, disable_irq, enable_irq
+from utime import ticks_us, ticks_diff
 
-from mavlink import HEARTBEAT, GLOBAL_POSITION_INT, STATUSTEXT, ATTITUDE, AHRS2, AHRS3
+import mavlink
+from mavlink import HEARTBEAT, GLOBAL_POSITION_INT, STATUSTEXT, ATTITUDE, AHRS2, AHRS3, CRC_EXTRA, PAYLOAD_LEN, \
+    REQUEST_DATA_STREAM, COMMAND_LONG, MAV_CMD_SET_MESSAGE_INTERVAL, MAV_COMP_ID_ONBOARD_COMPUTER, \
+    NAMED_VALUE_FLOAT, DEBUG_VECT, TUNNEL, MPSP_TUNNEL_PAYLOAD_TYPE, MAV_AUTOPILOT_INVALID
+from mavlink.crc import x25_crc, x25_accumulate
+from mpsp.log import LOG
+
+STX_V1 = const(0xFE)
+V1_HEADER_LEN = const(6)
+V1_OVERHEAD = const(8)
+
+STX_V2 = const(0xFD)
+V2_HEADER_LEN = const(10)
+V2_OVERHEAD = const(12)
+V2_SIGNATURE_LEN = const(13)
+V2_FLAG_SIGNED = const(0x01)
+
+MAX_PAYLOAD_LEN = const(255)
+
+# large enough to hold several max sized frames so the tail of a partial frame
+# never has to be moved on top of itself when the ring is rewound
+RX_BUFFER_SIZE = const(1024)
+
+# default budgets for a single MAVLink.poll
+POLL_BYTES = const(256)
+POLL_US = const(2000)
+
+# size of each of the two interrupt receive buffers
+RX_IRQ_BUFFER_SIZE = const(512)
+
+
+def compile_decoder(fmt):
+    """
+    return a callable(buffer, offset) that unpacks fmt in place.
+
+    ports without struct.Struct fall back to a closure over the format string
+    """
+    try:
+        return struct.Struct(fmt).unpack_from
+    except AttributeError:
+        unpack_from = struct.unpack_from
+
+        def decode(b, o):
+            return unpack_from(fmt, b, o)
+
+        return decode
+
+
+def decode_statustext(b, o):
+    return b[o], bytes(b[o + 1:o + 51])
+
+
+# message id -> decoder(buffer, offset). adding a message only requires an entry here
+DECODERS = {
+    HEARTBEAT: compile_decoder('<IBBBBB'),
+    GLOBAL_POSITION_INT: compile_decoder('<Iiiii'),
+    STATUSTEXT: decode_statustext,
+    ATTITUDE: compile_decoder('<Iffffff'),
+    AHRS2: compile_decoder('<IIffff'),
+    AHRS3: compile_decoder('<IIffffffff'),
+}
+
+# message id -> payload format for messages we send
+ENCODERS = {
+    REQUEST_DATA_STREAM: '<HBBBB',
+    COMMAND_LONG: '<fffffffHBBB',
+    NAMED_VALUE_FLOAT: '<If10s',
+    DEBUG_VECT: '<Qfff10s',
+    TUNNEL: '<HBBB128s',
+}
+
+
+def encode(buf, seq, sys_id, comp_id, mid, *fields):
+    """
+    pack a complete frame for mid into buf. ids above 255 need a v2 frame.
+    returns the frame length
+    """
+    n = PAYLOAD_LEN[mid]
+    if mid > 0xFF:
+        buf[0] = STX_V2
+        buf[1] = n
+        buf[2] = 0
+        buf[3] = 0
+        buf[4] = seq
+        buf[5] = sys_id
+        buf[6] = comp_id
+        buf[7] = mid & 0xFF
+        buf[8] = (mid >> 8) & 0xFF
+        buf[9] = mid >> 16
+        o = V2_HEADER_LEN
+    else:
+        buf[0] = STX_V1
+        buf[1] = n
+        buf[2] = seq
+        buf[3] = sys_id
+        buf[4] = comp_id
+        buf[5] = mid
+        o = V1_HEADER_LEN
+
+    struct.pack_into(ENCODERS[mid], buf, o, *fields)
+    o += n
+    crc = x25_accumulate(CRC_EXTRA[mid], x25_crc(buf, 1, o))
+    buf[o] = crc & 0xFF
+    buf[o + 1] = crc >> 8
+    return o + 2
 
 
 class Message:
+    """
+    MAVLink frame parser backed by a preallocated receive ring.
+
+    bytes are read straight into the ring with ``readinto``. ``next`` walks the
+    ring by index and leaves the header fields and payload offset of the frame
+    it found on the instance, so ``payload`` can decode in place. frames whose
+    message id has no entry in ``decoders`` are stepped over without decoding.
+
+    every frame with a known CRC_EXTRA is checksummed before it is handed out or
+    stepped over. a bad checksum, or a v2 header with unknown incompat flags,
+    only discards the start byte, so the scan resumes at the next start byte
+    inside the rejected frame rather than after its (possibly corrupt) length.
+    a frame with a plausible header but an id without a CRC_EXTRA (MEMINFO,
+    POWER_STATUS, ...) can not be checked. it is skipped whole by its length
+    only while the scan is in sync, i.e. the frame before it passed its
+    checksum; otherwise its start byte is given up on like a bad checksum, so a
+    false start can not jump over intact frames
+
+    v1 (0xFE) and v2 (0xFD) frames are parsed side by side. a v2 payload shorter
+    than PAYLOAD_LEN had its trailing zeros stripped by the sender; it is copied
+    into a preallocated scratch buffer and zero padded there, so ``source``
+    points at that buffer instead of the ring for that frame
+
+    link counters are kept as plain ints: ``received`` valid frames, ``dropped``
+    frames inferred from sequence gaps per sys/comp id (sources are only
+    tracked once a frame of theirs passed its checksum), ``crc_errors``,
+    ``resyncs`` (start bytes given up on), ``unknown`` frames skipped without a
+    CRC_EXTRA, ``nbytes`` received and ``lost``
+    bytes that did not fit in the ring
+    """
+    received = 0
+    dropped = 0
+    crc_errors = 0
+    resyncs = 0
+    unknown = 0
+    nbytes = 0
+    lost = 0
+
+    version = None
     payload_len = None
     seq_num = None
     sys_id = None
     comp_id = None
     message_id = None
+    offset = None
+    source = None
 
-    def __init__(self):
-        self._buffer = None
+    # the last frame looked at passed its checksum
+    _synced = False
+
+    def __init__(self, size=RX_BUFFER_SIZE, decoders=None):
+        if decoders is None:
+            decoders = DECODERS
+        self.decoders = decoders
+        self._size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._pad = bytearray(MAX_PAYLOAD_LEN)
+        self._head = 0
+        self._tail = 0
+        # (sys_id << 8 | comp_id) -> last sequence number
+        self._seqs = {}
 
     def clear(self):
-        self._buffer = None
+        self._head = 0
+        self._tail = 0
+        self._synced = False
+        self.version = None
+        self.source = None
         self.payload_len = None
         self.seq_num = None
         self.sys_id = None
         self.comp_id = None
         self.message_id = None
+        self.offset = None
+
+    def free(self):
+        """
+        contiguous bytes that can be written at the tail, after rewinding the
+        unparsed bytes if that is possible. unlike size - pending this is what
+        ``feed`` and ``readinto`` can actually take
+        """
+        return self._reserve(self._size)
+
+    def readinto(self, uart, n):
+        """
+        read up to n bytes from uart into the ring. returns the number of bytes read
+        """
+        n = self._reserve(n)
+        if n:
+            tail = self._tail
+            n = uart.readinto(self._view[tail:tail + n], n) or 0
+            self._tail = tail + n
+            self.nbytes += n
+        return n
 
     def update(self, buf):
+        """
+        copy buf into the ring. returns True if a complete frame is available
+        """
         if not buf:
             return
 
-        if self._buffer:
-            self._buffer += buf
-        else:
-            if buf[0] == 0xFE:
-                self._buffer = buf
-
+        self.feed(buf, len(buf))
         return self.complete()
 
+    def feed(self, buf, n):
+        """
+        copy the first n bytes of buf into the ring. returns the number of bytes copied
+        """
+        k = self._reserve(n)
+        if k:
+            tail = self._tail
+            self._buffer[tail:tail + k] = memoryview(buf)[0:k]
+            self._tail = tail + k
+        self.nbytes += n
+        if k < n:
+            self.lost += n - k
+            self._synced = False
+        return k
+
+    def reset_stats(self):
+        self.received = 0
+        self.dropped = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+        self.unknown = 0
+        self.nbytes = 0
+        self.lost = 0
+        self._seqs = {}
+
     def complete(self):
+        return self.next(peek=True)
+
+    def next(self, peek=False):
+        """
+        advance to the next complete frame in the ring.
+
+        bytes preceding a start byte are discarded. returns True and updates the
+        header attributes if a complete frame was found
+        """
         b = self._buffer
-        try:
-            self.payload_len = b[1]
-            self.seq_num = b[2]
-            self.sys_id = b[3]
-            self.comp_id = b[4]
-            self.message_id = b[5]
-        except (IndexError, TypeError):
-            return
-        nb = len(b) - 8
-        return nb >= self.payload_len
+        decoders = self.decoders
+        head = self._head
+        tail = self._tail
+        found = False
+        while head < tail:
+            stx = b[head]
+            if stx == STX_V1:
+                if tail - head < V1_HEADER_LEN:
+                    break
+
+                n = b[head + 1]
+                crc_end = head + V1_HEADER_LEN + n
+                end = crc_end + 2
+                if end > tail:
+                    break
+
+                mid = b[head + 5]
+                seq = head + 2
+                offset = head + V1_HEADER_LEN
+            elif stx == STX_V2:
+                if tail - head < V2_HEADER_LEN:
+                    break
+
+                flags = b[head + 2]
+                if flags & ~V2_FLAG_SIGNED:
+                    # no other incompat flags are defined, a false start
+                    self.resyncs += 1
+                    self._synced = False
+                    head += 1
+                    continue
+
+                n = b[head + 1]
+                crc_end = head + V2_HEADER_LEN + n
+                end = crc_end + 2
+                if flags & V2_FLAG_SIGNED:
+                    end += V2_SIGNATURE_LEN
+                if end > tail:
+                    break
+
+                mid = b[head + 7] | (b[head + 8] << 8) | (b[head + 9] << 16)
+                seq = head + 4
+                offset = head + V2_HEADER_LEN
+            else:
+                self._synced = False
+                head += 1
+                continue
+
+            extra = CRC_EXTRA.get(mid)
+            if extra is None:
+                if not self._synced:
+                    # nothing vouches for this header, its length may be garbage
+                    self.resyncs += 1
+                    head += 1
+                    continue
+
+                # a message we have no CRC_EXTRA for, skip it by its length. it
+                # still moves the sequence of a source already seen on, new
+                # sources are only added by frames that passed their crc
+                self.unknown += 1
+                key = (b[seq + 1] << 8) | b[seq + 2]
+                if key in self._seqs:
+                    self._seqs[key] = b[seq]
+                head = end
+                continue
+
+            crc = x25_accumulate(extra, x25_crc(b, head + 1, crc_end))
+            if crc != b[crc_end] | (b[crc_end + 1] << 8):
+                self.crc_errors += 1
+                self.resyncs += 1
+                self._synced = False
+                head += 1
+                continue
+
+            self._synced = True
+
+            skip = mid not in decoders
+            # a frame handed out by a peek is counted when next takes it
+            if skip or not peek:
+                self.received += 1
+                key = (b[seq + 1] << 8) | b[seq + 2]
+                last = self._seqs.get(key)
+                if last is not None:
+                    self.dropped += (b[seq] - last - 1) & 0xFF
+                self._seqs[key] = b[seq]
+
+            if skip:
+                head = end
+                continue
+
+            self.version = 1 if stx == STX_V1 else 2
+            self.payload_len = n
+            self.seq_num = b[seq]
+            self.sys_id = b[seq + 1]
+            self.comp_id = b[seq + 2]
+            self.message_id = mid
+
+            size = PAYLOAD_LEN.get(mid, n)
+            if n < size:
+                # v2 truncated payload
+                pad = self._pad
+                pad[0:n] = self._view[offset:offset + n]
+                for i in range(n, size):
+                    pad[i] = 0
+                self.source = pad
+                self.offset = 0
+            else:
+                self.source = b
+                self.offset = offset
+
+            if not peek:
+                head = end
+            found = True
+            break
+
+        self._head = head
+        if head == tail:
+            # nothing pending, rewind for free
+            self._head = self._tail = 0
+        return found
 
     def payload(self):
         mid = self.message_id
-        payload = None
-        buf = self._buffer[6:-2]
-        if mid == HEARTBEAT:
-            payload = struct.unpack('IBBBBB', buf)
-        elif mid == GLOBAL_POSITION_INT:
-            payload = struct.unpack('Iiiii', buf)
-        elif mid == STATUSTEXT:
-            severity = struct.unpack('B', buf)[0]
-            payload = (severity, buf[1:])
-        elif mid == ATTITUDE:
-            payload = struct.unpack('Iffffff', buf)
-        elif mid == AHRS2:
-            payload = struct.unpack('IIffff', buf)
-        elif mid == AHRS3:
-            payload = struct.unpack('IIffffffff', buf)
-
-        return self.message_id, payload
-
-    def extra(self):
-
-        e = self._buffer[self.payload_len + 8:]
-        if e:
-            msg = Message()
-            msg.update(e)
-            return msg
+        return mid, self.decoders[mid](self.source, self.offset)
+
+    def _reserve(self, n):
+        """
+        make room for n bytes at the tail, rewinding the unparsed bytes to the
+        start of the ring when the end is reached. returns the number of bytes
+        that can be written
+        """
+        size = self._size
+        tail = self._tail
+        if size - tail < n:
+            head = self._head
+            pending = tail - head
+            # only rewind when source and destination do not overlap
+            if head and pending <= head:
+                if pending:
+                    self._buffer[0:pending] = self._view[head:tail]
+                self._head = 0
+                self._tail = tail = pending
+            elif head == tail:
+                self._head = self._tail = tail = 0
+            elif tail == size and not head:
+                # a full ring without a frame is garbage, start over
+                self._head = self._tail = tail = 0
+                self._synced = False
+
+        return min(n, size - tail)
+
+
+class UARTReceiver:
+    """
+    drains a uart from a timer interrupt into one of two preallocated buffers.
+
+    the main loop swaps the buffers with ``take`` and parses the filled one while
+    the interrupt keeps filling the other, so slow sensor reads or SD writes no
+    longer let the uart's own receive buffer overflow. the callback only indexes
+    preallocated buffers and never allocates
+    """
+    def __init__(self, uart, timer_id, freq=200, size=RX_IRQ_BUFFER_SIZE):
+        try:
+            import micropython
+            micropython.alloc_emergency_exception_buf(100)
+        except ImportError:
+            pass
+
+        self._uart = uart
+        self.size = size
+        # set before the interrupt runs, += in the callback must not create the attribute
+        self.overruns = 0
+        self._buffers = (bytearray(size), bytearray(size))
+        self._active = 0
+        self._count = 0
+        self._timer = Timer(timer_id, freq=freq)
+        self._timer.callback(self._fill)
+
+    def take(self):
+        """
+        swap buffers. returns the filled buffer and the number of bytes in it
+        """
+        state = disable_irq()
+        buf = self._buffers[self._active]
+        n = self._count
+        self._active ^= 1
+        self._count = 0
+        enable_irq(state)
+        return buf, n
+
+    def deinit(self):
+        self._timer.callback(None)
+
+    def _fill(self, timer):
+        uart = self._uart
+        buf = self._buffers[self._active]
+        i = self._count
+        size = self.size
+        while uart.any():
+            if i == size:
+                self.overruns += 1
+                break
+            buf[i] = uart.readchar()
+            i += 1
+        self._count = i
+
+
+class LinkStats:
+    """
+    exposes the link counters of a MAVLink through ``get_measurement`` so they
+    can be logged like any other device
+    """
+    header = 'Received,Dropped,CRCErrors,Resyncs,Overruns,Bps,ParseUs'
+    last = None
+
+    def __init__(self, link):
+        self._link = link
+
+    def __str__(self):
+        return 'LinkStats'
+
+    def get_measurement(self):
+        self.last = self._link.stats()
+        return self.last
+
+
+class Downlink:
+    """
+    rate limited live summaries of the logged values, sent back over the MAVLink uart.
+
+    ``add`` latches the latest value per name, so nothing queues up between flushes.
+    ``flush`` runs from the main loop at most once per ``period`` ms and sends what
+    changed as NAMED_VALUE_FLOAT (one per scalar), DEBUG_VECT (up to three values per
+    name) or one or more batched TUNNEL frames. a byte token bucket keeps the
+    traffic under ``share`` of the link bandwidth. pyb.UART.write blocks for the
+    time on the wire, so ``max_us`` also bounds the time spent in one flush.
+    values that did not fit are sent on the next flush
+    """
+    NAMED_VALUE = 'named_value'
+    DEBUG = 'debug_vect'
+    BATCH = 'tunnel'
+
+    # frame sizes on the wire
+    _cost = {NAMED_VALUE: 26, DEBUG: 38, BATCH: 145}
+
+    def __init__(self, link, mode=NAMED_VALUE, share=0.1, period=1000, max_us=3000):
+        self._link = link
+        self._mode = mode
+        self._period = period
+        self._max_us = max_us
+        # bytes per second, 10 bits per byte on the uart
+        self._rate = link.baudrate // 10 * share
+        self._burst = max(self._rate * period // 1000, self._cost[mode])
+        self._tokens = self._burst
+        self._last = millis()
+        self._names = []
+        self._values = {}
+        self._dirty = {}
+        # name -> encoded name, and one encoded label per value for NAMED_VALUE_FLOAT
+        self._keys = {}
+        self._labels = {}
+        self._batch = bytearray(128)
+
+    def add(self, name, value):
+        """
+        latch value for name. value may be a number, a sequence of numbers or a csv string
+        """
+        if value is None:
+            return
+
+        if isinstance(value, str):
+            value = [float(v) for v in value.split(',')]
+        elif not isinstance(value, (list, tuple)):
+            value = (value,)
+
+        if name not in self._values:
+            self._names.append(name)
+            self._keys[name] = name[:10].encode()
+
+        labels = self._labels.get(name)
+        if labels is None or len(labels) != len(value):
+            if len(value) == 1:
+                labels = (name[:10].encode(),)
+            else:
+                labels = tuple('{}{}'.format(name[:9], i).encode() for i in range(len(value)))
+            self._labels[name] = labels
+
+        self._values[name] = value
+        self._dirty[name] = True
+
+    def flush(self):
+        now = millis()
+        dt = now - self._last
+        if dt < self._period:
+            return
+
+        self._last = now
+        self._tokens = min(self._burst, self._tokens + self._rate * dt // 1000)
+
+        st = ticks_us()
+        if self._mode == self.BATCH:
+            self._flush_batch(st)
+        else:
+            self._flush_each(st, now)
+
+    def _spend(self, st):
+        cost = self._cost[self._mode]
+        if self._tokens < cost or ticks_diff(ticks_us(), st) > self._max_us:
+            return False
+        self._tokens -= cost
+        return True
+
+    def _flush_each(self, st, now):
+        link = self._link
+        dirty = self._dirty
+        for name in self._names:
+            if not dirty[name]:
+                continue
+
+            vs = self._values[name]
+            if self._mode == self.DEBUG:
+                if not self._spend(st):
+                    return
+                x = vs[0]
+                y = vs[1] if len(vs) > 1 else 0
+                z = vs[2] if len(vs) > 2 else 0
+                link.send(DEBUG_VECT, now * 1000, x, y, z, self._keys[name])
+            else:
+                labels = self._labels[name]
+                for i, v in enumerate(vs):
+                    if not self._spend(st):
+                        return
+                    link.send(NAMED_VALUE_FLOAT, now, v, labels[i])
+            dirty[name] = False
+
+    def _flush_batch(self, st):
+        """
+        pack dirty values as [name_len, name, count, float32 * count] records into TUNNEL payloads.
+        a value stays dirty until the payload holding it was sent
+        """
+        dirty = self._dirty
+        batch = self._batch
+        pack_into = struct.pack_into
+        packed = []
+        o = 0
+        for name in self._names:
+            if not dirty[name]:
+                continue
+
+            vs = self._values[name]
+            key = self._keys[name]
+            nn = len(key)
+            size = 2 + nn + 4 * len(vs)
+            if size > 128:
+                # would never fit in a payload
+                LOG.warning('downlink', '{} too large to batch ({} values)', name, len(vs))
+                dirty[name] = False
+                continue
+
+            if o + size > 128:
+                if not self._send_batch(st, o):
+                    return
+                for p in packed:
+                    dirty[p] = False
+                packed = []
+                o = 0
+
+            batch[o] = nn
+            batch[o + 1:o + 1 + nn] = key
+            o += 1 + nn
+            batch[o] = len(vs)
+            o += 1
+            for v in vs:
+                pack_into('<f', batch, o, v)
+                o += 4
+            packed.append(name)
+
+        if o and self._send_batch(st, o):
+            for p in packed:
+                dirty[p] = False
+
+    def _send_batch(self, st, n):
+        if not self._spend(st):
+            return False
+
+        batch = self._batch
+        for i in range(n, 128):
+            batch[i] = 0
+        link = self._link
+        link.send(TUNNEL, MPSP_TUNNEL_PAYLOAD_TYPE, link.target_system, link.target_component, n, bytes(batch))
+        return True
 
 
 class MAVLink:
-    def __init__(self, uartID=6, baudrate=115200):
-        self._uart = UART(uartID, baudrate)
-        self.message = Message()
+    _receiver = None
+    _tx_seq = 0
+    # us spent parsing since the last stats() call
+    parse_us = 0
+    # optional mpsp.timing.Histogram of the time spent in every poll/parse call
+    parse_hist = None
+    target_system = 1
+    target_component = 1
+
+    def __init__(self, uartID=6, baudrate=115200, subscribe=None, irq_timer=None, irq_freq=200,
+                 read_buf_len=512, sys_id=1, comp_id=MAV_COMP_ID_ONBOARD_COMPUTER):
+        """
+        subscribe: iterable of message ids to decode. defaults to every id in DECODERS.
+        HEARTBEAT is always decoded
+
+        irq_timer: id of a free timer. when given the uart is drained in the background
+        by a UARTReceiver at irq_freq Hz
+
+        sys_id, comp_id: identity used for frames we send
+        """
+        self._uart = UART(uartID, baudrate, read_buf_len=read_buf_len)
+        self.baudrate = baudrate
+        self.sys_id = sys_id
+        self.comp_id = comp_id
+        self._tx = bytearray(MAX_PAYLOAD_LEN + V2_OVERHEAD)
+        self._tx_view = memoryview(self._tx)
+        decoders = None
+        if subscribe is not None:
+            decoders = {HEARTBEAT: DECODERS[HEARTBEAT]}
+            for mid in subscribe:
+                decoders[mid] = DECODERS[mid]
+
+        self.message = Message(decoders=decoders)
+        if irq_timer is not None:
+            self._receiver = UARTReceiver(self._uart, irq_timer, irq_freq)
+
+        self._stats_st = millis()
+        self._stats_nbytes = 0
+        self._stats_received = 0
+
+    def stats(self):
+        """
+        returns (received, dropped, crc_errors, resyncs, overruns, bytes/s, parse us/frame).
+        counts are totals, rates cover the time since the previous call. resets parse_us
+        """
+        msg = self.message
+        now = millis()
+        dt = now - self._stats_st
+
+        nbytes = msg.nbytes - self._stats_nbytes
+        received = msg.received - self._stats_received
+        # parse_us restarts every window so it stays a small int on the receive path
+        parse_us = self.parse_us
+        self.parse_us = 0
+
+        self._stats_st = now
+        self._stats_nbytes = msg.nbytes
+        self._stats_received = msg.received
+
+        overruns = msg.lost
+        if self._receiver:
+            overruns += self._receiver.overruns
+
+        bps = nbytes * 1000 // dt if dt else 0
+        us = parse_us // received if received else 0
+        return msg.received, msg.dropped, msg.crc_errors, msg.resyncs, overruns, bps, us
+
+    def deinit(self):
+        if self._receiver:
+            self._receiver.deinit()
+
+    def send(self, mid, *fields):
+        n = encode(self._tx, self._tx_seq, self.sys_id, self.comp_id, mid, *fields)
+        self._tx_seq = (self._tx_seq + 1) & 0xFF
+        self._uart.write(self._tx_view[0:n])
+
+    def request_message_interval(self, mid, rate):
+        """
+        ask the autopilot to stream mid at rate Hz with SET_MESSAGE_INTERVAL. rate <= 0 disables it
+        """
+        interval = 1000000 / rate if rate > 0 else -1
+        self.send(COMMAND_LONG, mid, interval, 0, 0, 0, 0, 0,
+                  MAV_CMD_SET_MESSAGE_INTERVAL, self.target_system, self.target_component, 0)
+
+    def request_data_stream(self, stream_id, rate):
+        """
+        legacy per stream group rate request. rate <= 0 stops the stream
+        """
+        self.send(REQUEST_DATA_STREAM, max(rate, 0), self.target_system, self.target_component,
+                  stream_id, 1 if rate > 0 else 0)
+
+    def request_rates(self, message_rates=None, data_streams=None):
+        """
+        send rate requests for {message name: Hz} and {MAV_DATA_STREAM_ suffix: Hz}
+        """
+        if data_streams:
+            for name, rate in data_streams.items():
+                sid = getattr(mavlink, 'MAV_DATA_STREAM_{}'.format(name), None)
+                if sid is None:
+                    LOG.warning('mavlink', 'unknown data stream {}', name)
+                else:
+                    self.request_data_stream(sid, rate)
+
+        if message_rates:
+            for name, rate in message_rates.items():
+                mid = getattr(mavlink, name, None)
+                if mid is None:
+                    LOG.warning('mavlink', 'unknown message {}', name)
+                else:
+                    self.request_message_interval(mid, rate)
 
     def wait_heartbeat(self, timeout=5):
         return self.wait_for(HEARTBEAT, timeout)
@@ -94,41 +769,116 @@ class MAVLink:
         while 1:
             now = millis()
             if now - st > timeout:
-                print('wait for timed out')
+                LOG.warning('mavlink', 'wait for {} timed out', mtype)
                 return
 
             msgs = self.get_messages()
             if msgs:
                 for msg in msgs:
                     if msg:
-                        print('wait for={}, msg={}'.format(mtype, msg))
+                        LOG.debug('mavlink', 'wait for={}, msg={}', mtype, msg)
                         if msg[0] == mtype:
                             return True
 
+    def poll(self, max_bytes=POLL_BYTES, max_us=POLL_US):
+        """
+        non-blocking read. takes at most max_bytes of what the uart already holds
+        and stops handing out frames once max_us have elapsed. frames left over
+        stay in the ring for the next call.
+
+        with an interrupt receiver the filled buffer is taken whole and max_bytes
+        does not apply
+        """
+        st = ticks_us()
+        msg = self.message
+        payloads = []
+
+        self._receive(max_bytes)
+        while msg.next():
+            payloads.append(self._payload(msg))
+            if ticks_diff(ticks_us(), st) > max_us:
+                break
+
+        et = ticks_diff(ticks_us(), st)
+        self.parse_us += et
+        if self.parse_hist is not None:
+            self.parse_hist.add(et)
+        return payloads
+
+    def parse(self, buf, n):
+        """
+        parse the first n bytes of buf, e.g. read from a stream, and return the decoded frames
+        """
+        st = ticks_us()
+        msg = self.message
+        msg.feed(buf, n)
+        payloads = []
+        while msg.next():
+            payloads.append(self._payload(msg))
+
+        et = ticks_diff(ticks_us(), st)
+        self.parse_us += et
+        if self.parse_hist is not None:
+            self.parse_hist.add(et)
+        return payloads
+
+    async def stream(self, handler, chunk=POLL_BYTES):
+        """
+        uasyncio coroutine that reads the uart as a stream and calls handler(frames)
+        for every chunk that completed frames. replaces poll, use it without an
+        interrupt receiver
+        """
+        import uasyncio as asyncio
+
+        reader = asyncio.StreamReader(self._uart)
+        while 1:
+            data = await reader.read(chunk)
+            if data:
+                msgs = self.parse(data, len(data))
+                if msgs:
+                    handler(msgs)
+
     def get_messages(self, timeout=750):
         st = millis()
 
-        msg = None
-        uart = self._uart
+        msg = self.message
         payloads = []
         while 1:
             now = millis()
             if now - st > timeout:
-                return
+                return payloads
 
-            n = uart.any()
-            if n:
-                if not msg:
-                    msg = Message()
+            if not self._receive(RX_BUFFER_SIZE):
+                return payloads
 
-                if msg.update(uart.read(n)):
-                    payloads.append(msg.payload())
-                    msg = msg.extra()
+            while msg.next():
+                payloads.append(self._payload(msg))
 
-            else:
-                if msg:
-                    if msg.complete():
-                        payloads.append(msg.payload())
-                return payloads
+    def _payload(self, msg):
+        payload = msg.payload()
+        if msg.message_id == HEARTBEAT and payload[1][2] != MAV_AUTOPILOT_INVALID:
+            # address our requests to the autopilot, not a GCS sharing the link
+            self.target_system = msg.sys_id
+            self.target_component = msg.comp_id
+        return payload
+
+    def _receive(self, max_bytes):
+        """
+        move received bytes into the parser ring. returns the number of bytes moved
+        """
+        msg = self.message
+        rx = self._receiver
+        if rx is None:
+            uart = self._uart
+            n = uart.any()
+            if n:
+                return msg.readinto(uart, min(n, max_bytes))
+        elif msg.free() >= rx.size:
+            # only swap when the whole buffer fits, otherwise leave it to the interrupt.
+            # free has already rewound the ring so feed gets that space
+            buf, n = rx.take()
+            if n:
+                return msg.feed(buf, n)
+        return 0
 
 # ============= EOF =============================================
@@ -19,4 +19,16 @@
 # ============= local library imports  ==========================
 FLIGHT = 10
 GROUNDTEST = 20
+
+# "runtime" in config.json
+LOOP = 'loop'
+ASYNC = 'async'
+
+# flight phases, derived from GLOBAL_POSITION_INT relative altitude
+PHASE_GROUND = 0
+PHASE_LANDING = 1
+PHASE_FLIGHT = 2
+
+# names used for the phases in config.json
+PHASES = {'ground': PHASE_GROUND, 'landing': PHASE_LANDING, 'flight': PHASE_FLIGHT}
 # ============= EOF =============================================
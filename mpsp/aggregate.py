@@ -0,0 +1,136 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+windowed aggregation of a device's measurements.
+
+an Aggregator stands in for a device. ``sample`` is called at the fast
+sample rate and folds every value into running statistics (Welford), one set
+per channel, kept in preallocated arrays. ``get_measurement`` returns the
+window summary
+
+    n, ch0 mean, ch0 min, ch0 max, ch0 stddev, ch1 mean, ...
+
+and starts the next window. n counts the samples, each channel keeps its own
+count so a None value is left out of that channel only. a channel without a
+value in the window is reported as nan. memory does not depend on the window
+length
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from array import array
+from math import sqrt
+# ============= local library imports  ==========================
+from mpsp.records import as_values
+
+NAN = float('nan')
+
+STATS = ('mean', 'min', 'max', 'sd')
+
+
+def aggregate_header(fields):
+    """
+    header of the summary record for a device whose values are ``fields``
+    """
+    hs = ['n']
+    for f in fields.split(','):
+        for s in STATS:
+            hs.append('{}_{}'.format(f, s))
+    return ','.join(hs)
+
+
+class Aggregator:
+    n = 0
+    channels = 0
+
+    def __init__(self, dev):
+        self.dev = dev
+
+    def sample(self):
+        """
+        read the device once and fold the values into the window. returns False
+        if the device had no value
+        """
+        m = self.dev.get_measurement()
+        if m is None:
+            return False
+
+        # numbers, sequences and csv strings (DHT22) alike
+        m = as_values(m)
+        nc = len(m)
+        if nc != self.channels:
+            self._allocate(nc)
+
+        self.n += 1
+        cnt = self._count
+        mean = self._mean
+        m2 = self._m2
+        mn = self._min
+        mx = self._max
+        for i, v in enumerate(m):
+            if v is None:
+                continue
+            k = cnt[i] + 1
+            cnt[i] = k
+            d = v - mean[i]
+            mean[i] += d / k
+            m2[i] += d * (v - mean[i])
+            if k == 1 or v < mn[i]:
+                mn[i] = v
+            if k == 1 or v > mx[i]:
+                mx[i] = v
+        return True
+
+    def get_measurement(self):
+        """
+        summary of the current window, None if nothing was sampled. resets the window
+        """
+        n = self.n
+        if not n:
+            return
+
+        out = [n]
+        for i in range(self.channels):
+            k = self._count[i]
+            if k:
+                sd = sqrt(self._m2[i] / (k - 1)) if k > 1 else 0
+                out.extend((self._mean[i], self._min[i], self._max[i], sd))
+            else:
+                out.extend((NAN, NAN, NAN, NAN))
+
+        self.reset()
+        return out
+
+    def reset(self):
+        self.n = 0
+        for a in (self._count, self._mean, self._m2, self._min, self._max):
+            for i in range(self.channels):
+                a[i] = 0
+
+    def _allocate(self, nc):
+        # the number of values changed, the window so far can not be continued
+        self.channels = nc
+        self.n = 0
+        self._count = array('I', [0] * nc)
+        # the board's floats are single precision, wider storage would gain nothing
+        self._mean = array('f', [0] * nc)
+        self._m2 = array('f', [0] * nc)
+        self._min = array('f', [0] * nc)
+        self._max = array('f', [0] * nc)
+
+    def __str__(self):
+        return 'Aggregate({})'.format(self.dev)
+
+# ============= EOF =============================================
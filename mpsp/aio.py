@@ -0,0 +1,102 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+helpers for the uasyncio runtime ("runtime": "async" in config.json). imports
+uasyncio, only import it when that runtime is used
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import uasyncio as asyncio
+from pyb import millis, LED
+# ============= local library imports  ==========================
+from mpsp.log import LOG
+from mpsp.events import TFUNC_LED
+
+
+class Prefetch:
+    """
+    stands in for a device that has get_measurement_async. the device task awaits
+    ``refresh`` before running the event, the event's get_measurement then only
+    returns the value that was read
+    """
+    value = None
+
+    def __init__(self, dev):
+        self.dev = dev
+
+    async def refresh(self):
+        self.value = await self.dev.get_measurement_async()
+
+    def get_measurement(self):
+        return self.value
+
+    def __str__(self):
+        return str(self.dev)
+
+
+async def periodic(func, period, *args):
+    """
+    call func(*args) every period ms until it returns True
+    """
+    while 1:
+        if func(*args):
+            return
+        await asyncio.sleep_ms(period)
+
+
+async def run_event(evt, ctx, start, dev=None, name='events'):
+    """
+    run an event_wrapper event as its own task from start (millis) on. the event
+    returns its next due time, a task that fell a whole period behind skips ahead.
+
+    like event_wrapper a failing read only lights the tfunc LED and is logged,
+    the task keeps running
+    """
+    due = start
+    # the event's period as of its last run, the retry delay after it raised
+    period = 1000
+    while 1:
+        d = due - millis()
+        if d > 0:
+            await asyncio.sleep_ms(d)
+
+        if dev is not None:
+            try:
+                await dev.refresh()
+            except (KeyboardInterrupt, asyncio.CancelledError) as e:
+                raise e
+            except BaseException as e:
+                # nothing is logged for this period rather than the previous value
+                dev.value = None
+                LED(TFUNC_LED).on()
+                LOG.warning(name, 'refresh exception={}', e)
+
+        try:
+            nxt = evt(ctx, due)
+            period = nxt - due
+        except (KeyboardInterrupt, asyncio.CancelledError) as e:
+            raise e
+        except BaseException as e:
+            LED(TFUNC_LED).on()
+            LOG.warning(name, 'event exception={}', e)
+            nxt = due + period
+
+        now = millis()
+        if nxt <= now:
+            nxt = now + nxt - due
+        due = nxt
+
+# ============= EOF =============================================
@@ -99,11 +99,31 @@ class ADS1115:
     def get_measurement(self):
         return [self.read_voltage(i) for i in (0,1,2,3)]
 
+    async def get_measurement_async(self):
+        """
+        uasyncio version of get_measurement, conversions are awaited instead of slept through
+        """
+        vs = []
+        for i in (0,1,2,3):
+            v = await self.read_async(i)
+            vs.append(v/2**16 *self.total_range)
+        return vs
+
     def read_voltage(self, channel):
         v = self.read(channel)
         v = v/2**16 *self.total_range
         return v
 
+    async def read_async(self, channel):
+        import uasyncio as asyncio
+
+        self._write_register(_REGISTER_CONFIG, _CQUE_NONE | _CLAT_NONLAT |
+            _CPOL_ACTVLOW | _CMODE_TRAD | _DR_1600SPS | _MODE_SINGLE |
+            _OS_SINGLE | _GAINS[self.gain] | _CHANNELS[channel])
+        while not self._read_register(_REGISTER_CONFIG) & _OS_NOTBUSY:
+            await asyncio.sleep_ms(1)
+        return self._read_register(_REGISTER_CONVERT)
+
     def read(self, channel):
         self._write_register(_REGISTER_CONFIG, _CQUE_NONE | _CLAT_NONLAT |
             _CPOL_ACTVLOW | _CMODE_TRAD | _DR_1600SPS | _MODE_SINGLE |
@@ -137,6 +157,10 @@ class ADS1015(ADS1115):
     def read(self, channel):
         return super().read(channel) >> 4
 
+    async def read_async(self, channel):
+        v = await super().read_async(channel)
+        return v >> 4
+
     def diff(self, channel1, channel2):
         return super().diff(channel1, channel2) >> 4
 
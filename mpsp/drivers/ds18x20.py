@@ -74,6 +74,28 @@ class DS18X20:
         data = ow.read_bytes(9)
         return self.convert_temp(rom[0], data)
 
+    async def get_measurement_async(self):
+        """
+        uasyncio version of get_measurement. all sensors convert at once and the
+        conversion (up to 750 ms) is awaited instead of busy waited
+        """
+        import uasyncio as asyncio
+
+        ow = self.ow
+        ow.reset()
+        ow.skip_rom()
+        ow.write_byte(0x44)  # Convert Temp
+        while not ow.read_bit():
+            await asyncio.sleep_ms(10)
+
+        temps = []
+        for rom in self.roms:
+            ow.reset()
+            ow.select_rom(rom)
+            ow.write_byte(0xbe)  # Read scratch
+            temps.append(self.convert_temp(rom[0], ow.read_bytes(9)))
+        return tuple(temps)
+
     def read_temps(self):
         """
         Read and return the temperatures of all attached DS18x20 devices.
@@ -19,132 +19,415 @@
 # ============= local library imports  ==========================
 
 # ============= EOF =============================================
-import io
 import os
 from pyb import millis, LED
+from utime import time, ticks_us, ticks_diff
+
+from mpsp.log import LOG
+from mpsp.session import SessionIndex
+from mpsp.timing import TIMING
+from mpsp.aggregate import Aggregator, aggregate_header
+from mpsp.writers import LogWriter, RecordLog, NORMAL, HIGH
 
 DATA_ROOT = '/sd/mpsp_data'
 
 OPEN_FILES = []
+SESSION = {}
+
+CSV = 'csv'
+BINARY = 'binary'
+
+# data logging options, updated from the "logging" section of config.json before devices are created
+LOGGING = {'format': CSV,
+           'buffer_size': 8192,
+           'flush_interval': 5000,
+           'flush_on_phase': True,
+           'session_file': False,
+           'high_water': 0.75,
+           'decimate': 0,
+           'stall_threshold': 50,
+           'drain_us': 3000,
+           'segment_size': 0,
+           'segment_ms': 0,
+           'preallocate': False,
+           'journal': False,
+           'compress': False,
+           'keyframe': 64}
 
 TFUNC_LED = const(3)
 
 
-def ads1115_event(dev, eid, period, display):
-    return csv_datalogger_wrapper(dev, 'ads115', 'A', 'A0,A1,A2,A3', eid, period, verbose=display)
+def ads1115_event(dev, eid, period, display, priority=NORMAL, sample_period=0, periods=None, trigger=None,
+                  sample_periods=None):
+    return datalogger_wrapper(dev, 'ads115', 'A', 'A0,A1,A2,A3', eid, period, verbose=display,
+                              priority=priority, sample_period=sample_period, periods=periods,
+                              trigger=trigger, sample_periods=sample_periods)
 
 
-def ds18x20_event(dev, eid, period, display):
-    return csv_datalogger_wrapper(dev, 'ds18x20', 'ds18', 'TempC', eid, period, verbose=display)
+def ds18x20_event(dev, eid, period, display, priority=NORMAL, sample_period=0, periods=None, trigger=None,
+                  sample_periods=None):
+    return datalogger_wrapper(dev, 'ds18x20', 'ds18', 'TempC', eid, period, verbose=display,
+                              priority=priority, sample_period=sample_period, periods=periods,
+                              trigger=trigger, sample_periods=sample_periods)
 
 
-def dht_event(dev, eid, period, display):
-    return csv_datalogger_wrapper(dev, 'dht', 'dht', 'Humidity%,TempC', eid, period, verbose=display)
+def dht_event(dev, eid, period, display, priority=NORMAL, sample_period=0, periods=None, trigger=None,
+                  sample_periods=None):
+    return datalogger_wrapper(dev, 'dht', 'dht', 'Humidity%,TempC', eid, period, verbose=display,
+                              priority=priority, sample_period=sample_period, periods=periods,
+                              trigger=trigger, sample_periods=sample_periods)
 
 
-def csv_datalogger_wrapper(dev, rootname, name, header, msg_idx, period, verbose=False):
-    try:
-        os.mkdir(DATA_ROOT)
-        print('Created DATA_ROOT')
-    except OSError:
-        print('DATA_ROOT {} exists'.format(DATA_ROOT))
+def link_stats_event(dev, eid, period):
+    return datalogger_wrapper(dev, 'link', 'link', dev.header, eid, period, code='I')
+
+
+def scan_next():
+    """
+    one past the highest numbered data file under DATA_ROOT. only used to seed a
+    new session index on a card that already holds data
+    """
+    cnt = 1
+    for d in os.listdir(DATA_ROOT):
+        try:
+            names = os.listdir('{}/{}'.format(DATA_ROOT, d))
+        except OSError:
+            continue
+
+        for f in names:
+            if '.' not in f:
+                continue
+
+            h, e = f.split('.')
+            if e in ('csv', 'bin'):
+                try:
+                    cnt = max(cnt, int(h.split('_')[0]) + 1)
+                except ValueError:
+                    pass
+    return cnt
+
 
+def session_index():
+    """
+    the SessionIndex for this boot. the first call starts a new session, which
+    numbers every data file opened until close_files
+    """
+    index = SESSION.get('index')
+    if index is None:
+        try:
+            os.mkdir(DATA_ROOT)
+            LOG.info('events', 'Created DATA_ROOT')
+        except OSError:
+            LOG.debug('events', 'DATA_ROOT {} exists', DATA_ROOT)
+
+        p = '{}/index.bin'.format(DATA_ROOT)
+        try:
+            os.stat(p)
+            index = SessionIndex(p)
+        except OSError:
+            index = SessionIndex(p, scan_next())
+        except ValueError:
+            LOG.warning('events', 'Rebuilding session index {}', p)
+            os.remove(p)
+            index = SessionIndex(p, scan_next())
+
+        index.begin(time())
+        LOG.info('events', 'Session {}', index.session)
+        SESSION['index'] = index
+        SESSION['start'] = millis()
+    return index
+
+
+def next_path(rootname, ext):
+    """
+    DATA_ROOT/rootname/NNNNNN.ext numbered by the current session
+    """
+    index = session_index()
     root = '{}/{}'.format(DATA_ROOT, rootname)
     try:
         os.mkdir(root)
-        print('Created Device Root')
+        LOG.info('events', 'Created Device Root {}', root)
     except OSError:
-        print('Device data root {} exists'.format(root))
+        LOG.debug('events', 'Device data root {} exists', root)
+
+    return '{}/{:06n}.{}'.format(root, index.session, ext)
+
+
+def open_writer(p):
+    """
+    LogWriter for p configured from LOGGING. with segment_size/segment_ms set p is
+    split into NNNNNN_SSS segments and every segment is listed in the session
+    index when it is opened and again with its size when it is closed. only
+    journaled segments are preallocated, the preallocated tail is not zeroed
+    and only the journal's block crcs tell it apart from data.
+
+    with LOGGING['journal'] the file is written as mpsp.journal blocks tagged with
+    the session number and a stream number, the order in which the writers were
+    opened
+    """
+    index = session_index()
+    jrnl = None
+    if LOGGING['journal']:
+        stream = SESSION.get('streams', 0)
+        SESSION['streams'] = stream + 1
+        jrnl = (index.session, stream)
+
+    w = LogWriter(p, 'wb',
+                  buffer_size=LOGGING['buffer_size'],
+                  flush_interval=LOGGING['flush_interval'],
+                  flush_on_phase=LOGGING['flush_on_phase'],
+                  high_water=LOGGING['high_water'],
+                  decimate=LOGGING['decimate'],
+                  stall_threshold=LOGGING['stall_threshold'],
+                  segment_size=LOGGING['segment_size'],
+                  segment_ms=LOGGING['segment_ms'],
+                  preallocate=LOGGING['preallocate'],
+                  journal=jrnl)
+    index.add_file(w.path, w.opened)
+
+    def rotated(writer, old):
+        path, opened, size = old
+        index.add_file(path, opened, size)
+        index.add_file(writer.path, writer.opened)
+        LOG.info('events', 'Rotated {} -> {}', path, writer.path)
+
+    w.add_rotate_hook(rotated)
+    return w
 
-    cnt = 1
-    for f in os.listdir(root):
-        if not f.endswith('.csv'):
-            continue
 
-        h, _ = f.split('.')
-        cnt = max(cnt, int(h) + 1)
+def close_files():
+    """
+    close every open data file, record the final sizes in the session index and
+    write the timing summary
+    """
+    index = SESSION.get('index')
+    for f in OPEN_FILES:
+        f.close()
+        if index is not None:
+            index.add_file(f.path, f.opened, f.size)
 
-    p = '{}/{:06n}.csv'.format(root, cnt)
+    if index is not None:
+        write_timing()
+        index.end(millis() - SESSION['start'])
 
-    # with io.open(p, 'w') as wfile:
-    #     header = 'GPS_BOOT_TIME, LAT, LON, ALT, REL_ALT,{}\n'.format(header)
-    #     wfile.write(header)
-    print('Device data file: {} -- {}'.format(dev, p))
-    wfile = io.open(p, 'w')
-    header = 'GPS_BOOT_TIME, LAT, LON, ALT, REL_ALT,{}\n'.format(header)
-    wfile.write(header)
-    #OPEN_FILES.append(wfile)
-    wfile.close()
+
+def write_timing():
+    """
+    log the TIMING summary and write it to DATA_ROOT/timing/NNNNNN.csv
+    """
+    if not TIMING.enabled:
+        return
+
+    TIMING.report()
+    p = next_path('timing', 'csv')
+    try:
+        TIMING.write(p)
+        SESSION['index'].add_file(p, millis(), os.stat(p)[6])
+    except OSError as e:
+        LOG.warning('events', 'timing summary {} failed {}', p, e)
+
+
+def keyframe():
+    """
+    RecordLog keyframe interval, 0 when LOGGING['compress'] is off
+    """
+    return LOGGING['keyframe'] if LOGGING['compress'] else 0
+
+
+def session_log():
+    """
+    the RecordLog shared by every device when LOGGING['session_file'] is set. all
+    devices are written as tagged records into one DATA_ROOT/session/NNNNNN.bin,
+    so a loop pass touches a single file. tools/mpsp_export.py demux splits it
+    back into per device tables
+    """
+    rlog = SESSION.get('log')
+    if rlog is None:
+        p = next_path('session', 'bin')
+        LOG.info('events', 'Session data file: {}', p)
+        wfile = open_writer(p)
+        rlog = RecordLog(wfile, keyframe=keyframe())
+        SESSION['log'] = rlog
+        OPEN_FILES.append(wfile)
+    return rlog
+
+
+def datalogger_wrapper(dev, rootname, name, header, msg_idx, period, verbose=False, code='f', priority=NORMAL,
+                       sample_period=0, periods=None, trigger=None, sample_periods=None):
+    """
+    periodic event that samples dev and logs it under DATA_ROOT/rootname as csv
+    rows or, with LOGGING['format'] == BINARY, as mpsp.records samples whose values
+    are packed with the struct code ``code``. ``priority`` decides whether rows
+    are shed first when the writer's RAM ring backs up. with
+    LOGGING['session_file'] the samples go into the shared session log instead.
+
+    with a sample_period shorter than period dev is read every sample_period ms
+    into an mpsp.aggregate.Aggregator and one summary record (n and mean, min,
+    max, stddev of every value) is logged per period.
+
+    ``periods`` maps flight phases to periods that replace period while the
+    phase in ctx['rate_phase'] is one of them, see event_wrapper. for an
+    aggregated device ``sample_periods`` does the same for sample_period,
+    without it sample_period is scaled with the phase's period so every
+    window holds the same number of samples.
+
+    with a ``trigger`` (mpsp.spatial.DistanceTrigger) a sample, or the summary
+    of the samples since the last one, is only logged once the vehicle has
+    moved far enough. period is then how often the position is checked
+    """
+    binary = LOGGING['format'] == BINARY
+    agg = None
+    if 0 < sample_period < period:
+        agg = Aggregator(dev)
+        dev = agg
+        header = aggregate_header(header)
+        if periods and not sample_periods:
+            sample_periods = {ph: max(1, sample_period * p // period) for ph, p in periods.items()}
+    if LOGGING['session_file']:
+        rlog = session_log()
+        wfile = rlog.writer
+        tag = rlog.add_device(name, code, header)
+        LOG.info(name, 'Device data: {} -- {} tag={}', dev, wfile.path, tag)
+    else:
+        p = next_path(rootname, 'bin' if binary else 'csv')
+        LOG.info(name, 'Device data file: {} -- {}', dev, p)
+        wfile = open_writer(p)
+        rlog = None
+        tag = None
+        if binary:
+            rlog = RecordLog(wfile, keyframe=keyframe())
+            tag = rlog.add_device(name, code, header)
+        else:
+            header = 'GPS_BOOT_TIME, LAT, LON, ALT, REL_ALT,{}\n'.format(header)
+            wfile.write(header, HIGH)
+            wfile.add_rotate_hook(lambda w, old: w.write(header, HIGH))
+        OPEN_FILES.append(wfile)
 
     st = millis()
 
     def tfunc(ctx):
         m = dev.get_measurement()
-        print((millis() - st) / 1000, dev, m)
+        LOG.debug(name, '{} {} {}', (millis() - st) / 1000, dev, m)
         if verbose and ctx.get('display_enabled', True):
             try:
                 from display import DISPLAY
                 # print('{}={}'.format(dev, m))
-                if isinstance(m, (list, tuple)):
-                    for i, mi in enumerate(m):
+                # a summary has too many values for the display, show the means
+                dm = m[1::4] if agg is not None and m is not None else m
+                if isinstance(dm, (list, tuple)):
+                    for i, mi in enumerate(dm):
                         DISPLAY.message('{}{}:{}'.format(name, i, mi), msg_idx + i)
                 else:
-                    DISPLAY.message('{}:{}'.format(name, m if m is not None else '---'), msg_idx)
+                    DISPLAY.message('{}:{}'.format(name, dm if dm is not None else '---'), msg_idx)
             except OSError as e:
-                print('display error {}'.format(e))
+                LOG.warning(name, 'display error {}', e)
 
         if m is not None:
+            downlink = ctx.get('downlink')
+            if downlink is not None:
+                downlink.add(name, m)
+
             try:
-                with open(p, 'a') as wfile:
+                if rlog is not None:
+                    rlog.write(tag, millis(), ctx.get('gps'), m, priority)
+                else:
                     gps = ctx.get('gps', (None, None, None, None, None))
                     gps = ','.join(map(str, gps))
                     if isinstance(m, (list, tuple)):
                         m = ','.join(map(str, m))
                     d = '{},{}\n'.format(gps, m)
-                    wfile.write(d)
-
-                # # with open(p, 'a') as afile:
-                # gps = ctx.get('gps', (None, None, None, None, None))
-                # gps = ','.join(map(str, gps))
-                # if isinstance(m, (list, tuple)):
-                #     m = ','.join(map(str, m))
-                # try:
-                #     ctx['wfile'].write('{},{}\n'.format(gps, m))
-                # except OSError as e:
-                #     ctx['wfile'].close()
-                #     print('write error {}'.format(e))
-                #     ctx['wfile'] = io.open(p, 'a')
-                #
-                # if not ctx['iteration'] % 3:
-                #     wfile.flush()
+                    wfile.write(d, priority)
             except KeyboardInterrupt:
                 # never allow Ctrl+C when writing to disk
                 pass
 
-    return event_wrapper(tfunc, None, period)
+    if trigger is not None:
+        sample_tfunc = tfunc
+
+        def tfunc(ctx):
+            if agg is not None and not agg.sample():
+                LOG.warning(name, 'no value from {}', agg.dev)
+            gps = ctx.get('gps')
+            if trigger(gps):
+                sample_tfunc(ctx)
+            elif trigger.stale(gps, millis()):
+                LOG.warning(name, 'position not updating, distance trigger is waiting')
+
+        if agg is not None:
+            return event_wrapper(tfunc, None, sample_period, name=name, periods=sample_periods)
+        return event_wrapper(tfunc, None, period, name=name, periods=periods)
+
+    if agg is None:
+        return event_wrapper(tfunc, None, period, name=name, periods=periods)
+
+    window = {'start': None}
+    log_tfunc = tfunc
+
+    def tfunc(ctx):
+        if not agg.sample():
+            LOG.warning(name, 'no value from {}', agg.dev)
+        now = millis()
+        p = periods.get(ctx.get('rate_phase'), period) if periods else period
+        if window['start'] is None:
+            window['start'] = now
+        elif now - window['start'] >= p:
+            window['start'] = now
+            log_tfunc(ctx)
+
+    return event_wrapper(tfunc, None, sample_period, name=name, periods=sample_periods)
 
 
-def event_wrapper(tfunc, ffunc, period, count_threshold=0, iteration_threshold=100):
-    ctx = {'last_call': millis(), 'cnt': 0, 'iteration': 0, 'flopbit': 0, 'pflopbit': 0, 'display_enabled': True}
+def event_wrapper(tfunc, ffunc, period, count_threshold=0, iteration_threshold=100, name=None, periods=None):
+    """
+    periodic event. called as func(mctx) it checks its own period. called by
+    mpsp.scheduler.Scheduler as func(mctx, due) it runs unconditionally and returns
+    its next due time.
 
-    def func(mctx):
+    with a name every tfunc call is timed into the TIMING histograms
+    <name>.exec and <name>.period.
+
+    ``periods`` is {phase: period}. while mctx['rate_phase'] (set by MPSP once a
+    flight phase has held for a while) is in it that period is used instead,
+    the change takes effect from the next run
+    """
+    ctx = {'last_call': millis(), 'cnt': 0, 'iteration': 0, 'flopbit': 0, 'pflopbit': 0, 'display_enabled': True,
+           'started': None, 'expected': period * 1000}
+    exec_hist = None
+    period_hist = None
+    if name is not None:
+        exec_hist = TIMING.histogram('{}.exec'.format(name))
+        period_hist = TIMING.histogram('{}.period'.format(name), period * 1000)
+
+    def func(mctx, due=None):
+        p = period
+        if periods is not None:
+            p = periods.get(mctx.get('rate_phase'), period)
 
         # permanently disable display
         if ctx['iteration'] >= 50:
             ctx['display_enabled'] = False
 
-        if millis() - ctx['last_call'] > period:
+        if due is not None or millis() - ctx['last_call'] > p:
             ctx['pflopbit'] = ctx['flopbit']
             ctx['flopbit'] = 1
             if tfunc is not None:
                 mctx['iteration'] = ctx['iteration']
+                st = ticks_us()
+                if period_hist is not None:
+                    if ctx['started'] is not None:
+                        period_hist.add(ticks_diff(st, ctx['started']) - ctx['expected'])
+                    ctx['started'] = st
+                    ctx['expected'] = p * 1000
                 try:
                     tfunc(mctx)
                 except KeyboardInterrupt as e:
                     raise e
                 except BaseException as e:
                     LED(TFUNC_LED).on()
-                    print('tfunc exception={}, mctx={}'.format(e, mctx))
+                    # warning, not error, so a sensor failing every sample is rate limited
+                    LOG.warning(name or 'events', 'tfunc exception={}', e)
+                if exec_hist is not None:
+                    exec_hist.add(ticks_diff(ticks_us(), st))
             ctx['cnt'] += 1
             ctx['iteration'] += 1
             if ctx['iteration'] >= iteration_threshold:
@@ -162,6 +445,9 @@ def event_wrapper(tfunc, ffunc, period, count_threshold=0, iteration_threshold=1
                 except KeyboardInterrupt as e:
                     raise e
                 except BaseException as e:
-                    print('ffunc exception={}'.format(e))
+                    LOG.warning(name or 'events', 'ffunc exception={}', e)
+
+        if due is not None:
+            return due + p
 
     return func
@@ -0,0 +1,68 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+crash safe block journal, written by the board. blocks are checked and
+scanned on the host by tools/mpsp_readers.py.
+
+a journaled log is a sequence of 512 byte blocks, one per SD sector
+
+    <4sIHHII MAGIC, session, stream, payload length, sequence, crc32> payload, zero fill
+
+the crc covers the header after MAGIC (with the crc field zeroed) and the
+payload. a block holds only whole writes (records or csv rows), so every intact
+block can be decoded on its own, whatever happened to its neighbours. the
+sequence number counts blocks per stream and keeps counting across segments
+
+this module must not import pyb
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import struct
+
+try:
+    from binascii import crc32
+except ImportError:
+    from ubinascii import crc32
+# ============= local library imports  ==========================
+
+BLOCK = 512
+MAGIC = b'MPSJ'
+HEADER_FORMAT = '<4sIHHII'
+HEADER_LEN = 20
+CRC_OFFSET = 16
+PAYLOAD_LEN = BLOCK - HEADER_LEN
+
+_ZERO_CRC = b'\0\0\0\0'
+
+
+def block_crc(block, n):
+    """
+    crc32 of a block whose payload is n bytes long
+    """
+    mv = memoryview(block)
+    crc = crc32(mv[4:CRC_OFFSET])
+    crc = crc32(_ZERO_CRC, crc)
+    return crc32(mv[HEADER_LEN:HEADER_LEN + n], crc) & 0xFFFFFFFF
+
+
+def seal(block, session, stream, seq, n):
+    """
+    fill in the header of a block whose payload is n bytes long
+    """
+    struct.pack_into(HEADER_FORMAT, block, 0, MAGIC, session, stream, n, seq, 0)
+    struct.pack_into('<I', block, CRC_OFFSET, block_crc(block, n))
+
+# ============= EOF =============================================
@@ -0,0 +1,156 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+leveled, rate limited logging.
+
+messages at or above ``level`` are kept in a RAM ring of the most recent
+``ring`` messages, those at or above ``console`` are also sent to the USB
+console. console writes never block, a message the host is not reading is
+dropped. below ERROR each source may send a burst of ``burst`` messages and
+then one per ``rate_ms``, the suppressed count is appended to the next message
+that gets through. messages are only formatted once they pass both checks
+
+    from mpsp.log import LOG
+    LOG.info('mpsp', 'loaded {} devices', n)
+    LOG.dump()      # from the REPL
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from pyb import millis, USB_VCP
+# ============= local library imports  ==========================
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+NAMES = {DEBUG: 'D', INFO: 'I', WARNING: 'W', ERROR: 'E'}
+
+
+class Log:
+    suppressed = 0
+    dropped = 0
+
+    def __init__(self, ring=32, level=INFO, console=INFO, rate_ms=1000, burst=8):
+        self._vcp = None
+        # source -> [tokens, last refill, suppressed]
+        self._sources = {}
+        self.configure(ring, level, console, rate_ms, burst)
+
+    def configure(self, ring=None, level=None, console=None, rate_ms=None, burst=None):
+        """
+        levels may be given as numbers or as names from LEVELS
+        """
+        if ring is not None:
+            self._ring = [None] * ring
+            self._idx = 0
+        if level is not None:
+            self.level = LEVELS.get(level, level)
+        if console is not None:
+            self.console = LEVELS.get(console, console)
+        if rate_ms is not None:
+            self.rate_ms = rate_ms
+        if burst is not None:
+            self.burst = burst
+
+    def debug(self, source, msg, *args):
+        self.log(DEBUG, source, msg, *args)
+
+    def info(self, source, msg, *args):
+        self.log(INFO, source, msg, *args)
+
+    def warning(self, source, msg, *args):
+        self.log(WARNING, source, msg, *args)
+
+    def error(self, source, msg, *args):
+        self.log(ERROR, source, msg, *args)
+
+    def log(self, level, source, msg, *args):
+        if level < self.level and level < self.console:
+            return
+
+        now = millis()
+        skipped = 0
+        rate = self.rate_ms
+        if level < ERROR and rate:
+            src = self._sources.get(source)
+            if src is None:
+                src = [self.burst, now, 0]
+                self._sources[source] = src
+            else:
+                refill = (now - src[1]) // rate
+                if refill:
+                    src[0] = min(self.burst, src[0] + refill)
+                    src[1] += refill * rate
+
+            if src[0] <= 0:
+                src[2] += 1
+                self.suppressed += 1
+                return
+
+            src[0] -= 1
+            skipped = src[2]
+            src[2] = 0
+
+        if args:
+            msg = msg.format(*args)
+        if skipped:
+            msg = '{} (+{} suppressed)'.format(msg, skipped)
+
+        if level >= self.level:
+            ring = self._ring
+            idx = self._idx
+            ring[idx % len(ring)] = (now, level, source, msg)
+            self._idx = idx + 1
+
+        if level >= self.console:
+            self._write('{} {} {}: {}\r\n'.format(now, NAMES.get(level, level), source, msg))
+
+    def recent(self, n=None):
+        """
+        the last n messages in the ring, oldest first, as (millis, level, source, message)
+        """
+        ring = self._ring
+        size = len(ring)
+        idx = self._idx
+        m = min(idx, size)
+        if n is not None:
+            m = min(m, n)
+        return [ring[i % size] for i in range(idx - m, idx)]
+
+    def dump(self, n=None):
+        """
+        print the ring. blocks on the console, meant for the REPL
+        """
+        for now, level, source, msg in self.recent(n):
+            print(now, NAMES.get(level, level), source, msg)
+        print('suppressed={} dropped={}'.format(self.suppressed, self.dropped))
+
+    def _write(self, line):
+        vcp = self._vcp
+        if vcp is None:
+            vcp = USB_VCP()
+            self._vcp = vcp
+
+        if not vcp.isconnected() or vcp.send(line, timeout=0) < len(line):
+            self.dropped += 1
+
+
+LOG = Log()
+
+# ============= EOF =============================================
@@ -17,17 +17,26 @@
 import json
 import os
 
-from pyb import millis, LED, Pin, delay, SPI, Timer, Switch, I2C
+from pyb import millis, LED, Pin, delay, SPI, Timer, Switch, I2C, wfi
+from utime import ticks_us, ticks_diff
 from mavlink import GLOBAL_POSITION_INT, HEARTBEAT, ATTITUDE
-from mavlink.mavlink import MAVLink
-from mpsp import FLIGHT
-from mpsp.events import ads1115_event, ds18x20_event, dht_event, OPEN_FILES
+from mavlink.mavlink import MAVLink, LinkStats, Downlink, POLL_BYTES, POLL_US
+from mpsp import FLIGHT, PHASE_GROUND, PHASE_LANDING, PHASE_FLIGHT, PHASES, LOOP, ASYNC
+from mpsp.events import ads1115_event, ds18x20_event, dht_event, link_stats_event, OPEN_FILES, LOGGING, \
+    close_files
+from mpsp.writers import PRIORITIES, drain_all
+from mpsp.log import LOG, OFF
+from mpsp.scheduler import Scheduler
+from mpsp.timing import TIMING
+from mpsp.spatial import DistanceTrigger
 from mpsp.led_patterns import TAIL_FLIGHT_PATTERN, TAIL_LANDING_PATTERN, TAIL_GROUND_PATTERN, TAIL_CLEAR, \
     DOME_FLIGHT_PATTERN, DOME_GROUND_PATTERN, STATUS_PATTERN
 
 # RESERVED TIMERS 2,3,5,6
 STATUS_TIMER = const(1)
+UART_TIMER = const(4)
 HEARTBEAT_TIMER = const(7)
+HEARTBEAT_TIMEOUT = const(5000)
 LED_TIMER = const(8)
 STATUS_LED = const(2)
 
@@ -47,10 +56,27 @@ class MPSP:
     _tail_cnt = 0
     _current_hash = None
     _event_delay = 0
+    _link_stats = None
+    _downlink = None
+    _poll_bytes = POLL_BYTES
+    _poll_us = POLL_US
+    _message_rates = None
+    _data_streams = None
+    _drain_us = 3000
+    _storage_period = 50
+    _runtime = LOOP
+    _hbwtim = None
+    _hb_lost = False
+    _phase_hold = 3000
+    _pending_phase = None
+    _pending_since = 0
 
     def __init__(self, mode):
         self._mode = mode
         self._status_pattern = STATUS_PATTERN
+        if mode == FLIGHT:
+            # nobody is reading the console in flight
+            LOG.configure(console=OFF)
 
     def _make_header(self, status_flag=False, heartbeat_flag=False):
         mode = 'F' if self._mode == FLIGHT else 'G'
@@ -63,14 +89,18 @@ class MPSP:
 
         h11 = '{:<5s}'.format(flags)
         h1 = '{}{}'.format(h1,h11)
-        return h1, ''
+
+        h2 = ''
+        if self._link_stats and self._link_stats.last:
+            # dropped, crc errors, bytes/s
+            s = self._link_stats.last
+            h2 = 'D{} C{} {}B/s'.format(s[1], s[2], s[5])
+        return h1, h2
 
     def init(self):
-        print('FlightM Mode = {}'.format(self._mode == FLIGHT))
+        LOG.info('mpsp', 'FlightM Mode = {}', self._mode == FLIGHT)
 
         evts = []
-        if self._mode == FLIGHT:
-            self._mavlink = MAVLink()
 
         try:
             os.mkdir('/sd/mpsp_data')
@@ -80,11 +110,38 @@ class MPSP:
         names = []
         with open('mpsp/config.json', 'r') as rfile:
             obj = json.loads(rfile.read())
-            print(obj)
+            lg = obj.get('log', {})
+            LOG.configure(ring=lg.get('ring', 32),
+                          level=lg.get('level', 'info'),
+                          console=lg.get('flight_console', 'off') if self._mode == FLIGHT else lg.get('console', 'info'),
+                          rate_ms=lg.get('rate_ms', 1000),
+                          burst=lg.get('burst', 8))
+            LOG.debug('mpsp', 'config {}', obj)
+            tm = obj.get('timing', {})
+            TIMING.configure(enabled=tm.get('enabled', True), buckets=tm.get('buckets', 16))
             self._period = obj['loop_period']
             self._oled_enabled = obj['oled_enabled']
             self._dome_led_pin = obj.get('dome_led_pin','X2')
             self._event_delay = obj.get('event_delay', 30)
+            self._phase_hold = obj.get('phase_hold', 3000)
+            LOGGING.update(obj.get('logging', {}))
+            self._drain_us = LOGGING['drain_us']
+
+            mav = obj.get('mavlink', {})
+            self._poll_bytes = mav.get('poll_bytes', POLL_BYTES)
+            self._poll_us = mav.get('poll_us', POLL_US)
+            self._message_rates = mav.get('message_rates')
+            self._data_streams = mav.get('data_streams')
+            self._runtime = obj.get('runtime', LOOP)
+            self._storage_period = obj.get('storage_period', 50)
+            if self._mode == FLIGHT:
+                # the async runtime reads the uart as a stream instead
+                irq_timer = UART_TIMER if mav.get('rx_irq', True) and self._runtime == LOOP else None
+                self._mavlink = MAVLink(subscribe=(GLOBAL_POSITION_INT, ATTITUDE),
+                                        irq_timer=irq_timer,
+                                        irq_freq=mav.get('rx_irq_freq', 200))
+                self._mavlink.parse_hist = TIMING.histogram('mavlink.poll')
+
             eid = 2
             for di in obj.get('devices'):
                 if di.get('enabled'):
@@ -93,9 +150,22 @@ class MPSP:
 
                     if evt is not None:
                         eid += 1
-                        evts.append(evt)
+                        evts.append((evt[0], di.get('name', di['klass']), evt[1]))
                         names.append(di)
 
+            dl = obj.get('downlink', {})
+            if self._mavlink and dl.get('enabled'):
+                self._downlink = Downlink(self._mavlink,
+                                          mode=dl.get('mode', Downlink.NAMED_VALUE),
+                                          share=dl.get('link_share', 0.1),
+                                          period=dl.get('period', 1000),
+                                          max_us=dl.get('max_us', 3000))
+
+            stats_period = mav.get('stats_period', 5000)
+            if self._mavlink and stats_period:
+                self._link_stats = LinkStats(self._mavlink)
+                evts.append((link_stats_event(self._link_stats, eid, stats_period), 'link', self._link_stats))
+
         if self._oled_enabled:
             from display import DISPLAY
 
@@ -115,11 +185,9 @@ class MPSP:
         self._led_timer.callback(self._led_cb)
 
     def run(self):
-        print('run')
-        heartbeat_timeout = 5000
+        LOG.info('mpsp', 'run')
 
         self._warning_led = LED(WARNING_LED)
-        wl = self._warning_led
 
         if self._mode == FLIGHT:
             if not self._mavlink.wait_heartbeat():
@@ -132,21 +200,29 @@ class MPSP:
 
                 return
 
-        switch = Switch()
-        hbwtim = None
+            # the heartbeat timeout runs from here, not from boot
+            self._last_hb = millis()
+            self._request_rates()
+
         ctx = {}
-        cnt = 0
-        evts = self._events
+        if self._downlink:
+            ctx['downlink'] = self._downlink
 
-        st = millis()
-        evt_delay = self._event_delay
+        if self._runtime == ASYNC:
+            self._run_async(ctx)
+            return
+
+        switch = Switch()
+        sched = None
+        loop_hist = TIMING.histogram('loop')
+        display_hist = TIMING.histogram('display')
 
         sflag = False
         hflag = False
         lt=None
-        heartbeat=False
         hd=250
         while 1:
+            pst = ticks_us()
             if self._oled_enabled:
                 et = hd+1
                 if lt:
@@ -154,61 +230,37 @@ class MPSP:
                 if et > hd:
                     lt = millis()
                     from display import DISPLAY
+                    dst = ticks_us()
                     DISPLAY.header(*self._make_header(sflag, hflag))
+                    if display_hist is not None:
+                        display_hist.add(ticks_diff(ticks_us(), dst))
                     sflag = not sflag
-                    if heartbeat:
+                    if self._hb_lost:
                         hflag = not hflag
 
             try:
-                now = millis()
                 if self._mode == FLIGHT:
-                    # check for heartbeat timeout
-                    if now - self._last_hb > heartbeat_timeout:
-                        heartbeat = True
-                        if hbwtim is None:
-                            hbwtim = Timer(HEARTBEAT_TIMER, freq=10)
-                            hbwtim.callback(lambda t: wl.toggle())
-                    elif hbwtim:
-                        heartbeat = False
-                        wl.off()
-                        hbwtim.callback(None)
-                        hbwtim = None
-
-                    msgs = self._mavlink.get_messages()
+                    self._check_heartbeat()
+
+                    msgs = self._mavlink.poll(self._poll_bytes, self._poll_us)
                     if msgs:
-                        for msg in msgs:
-                            mid = msg[0]
-                            if mid == HEARTBEAT:
-                                self._last_hb = millis()
-                            elif mid == GLOBAL_POSITION_INT:
-                                ctx['gps'] = msg[1]
-                                relalt = abs(msg[1][4]-msg[1][3])
-                                if relalt >1000: # 1 meter
-                                    self._dome_pattern = DOME_FLIGHT_PATTERN
-                                    self._tail_pattern = TAIL_FLIGHT_PATTERN
-                                elif relalt > 500:
-                                    self._tail_pattern = TAIL_LANDING_PATTERN
-                                else:
-                                    self._dome_pattern = DOME_GROUND_PATTERN
-                                    self._tail_pattern = TAIL_GROUND_PATTERN
-
-                            elif mid == ATTITUDE:
-                                ctx['attitude'] = msg[1]
+                        self._handle_messages(msgs, ctx)
 
                     # wait until have a gps signal before starting to save
                     if 'gps' not in ctx:
+                        wfi()
                         continue
 
-                et = millis() - st
-                if evts and et > evt_delay:
-                    try:
-                        evt = evts[cnt]
-                    except IndexError:
-                        evt = evts[0]
-                        cnt = 0
+                if sched is None:
+                    # start the clock once logging can begin
+                    sched = self._make_scheduler(millis() + self._event_delay)
+                sched.run(ctx)
 
-                    cnt += 1
-                    evt(ctx)
+                if self._downlink:
+                    self._downlink.flush()
+
+                # move whole sectors from the RAM rings to the card with whatever time is left
+                drain_all(OPEN_FILES, self._drain_us)
 
             except KeyboardInterrupt:
                 self._cancel()
@@ -218,12 +270,161 @@ class MPSP:
                 self._cancel()
                 break
 
-        if OPEN_FILES:
-            for f in OPEN_FILES:
-                f.close()
+            if loop_hist is not None:
+                # the pass without the idle wait
+                loop_hist.add(ticks_diff(ticks_us(), pst))
+
+            if sched:
+                sched.idle()
+
+        if sched:
+            sched.report()
+        close_files()
 
         self._cleanup()
 
+    def _run_async(self, ctx):
+        """
+        uasyncio runtime. the MAVLink reader is a stream coroutine on the uart and
+        every device, the display, the heartbeat monitor, the storage drain and the
+        switch are separate tasks, so a device that awaits its conversion does not
+        hold up the others
+        """
+        import uasyncio as asyncio
+        from mpsp.aio import periodic
+
+        async def main():
+            tasks = []
+            if self._mode == FLIGHT:
+                tasks.append(asyncio.create_task(self._mavlink.stream(lambda msgs: self._handle_messages(msgs, ctx),
+                                                                      self._poll_bytes)))
+                tasks.append(asyncio.create_task(periodic(self._check_heartbeat, 100)))
+            if self._oled_enabled:
+                tasks.append(asyncio.create_task(self._display_task()))
+            tasks.append(asyncio.create_task(periodic(self._storage_task, self._storage_period)))
+
+            tasks.append(asyncio.create_task(self._device_tasks(ctx)))
+
+            switch = Switch()
+            await periodic(switch, 100)
+            for t in tasks:
+                t.cancel()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+        self._cancel()
+        close_files()
+
+    async def _device_tasks(self, ctx):
+        import uasyncio as asyncio
+        from mpsp.aio import Prefetch, run_event
+
+        # wait until have a gps signal before starting to save
+        while self._mode == FLIGHT and 'gps' not in ctx:
+            await asyncio.sleep_ms(100)
+
+        start = millis() + self._event_delay
+        for evt, name, dev in self._events:
+            asyncio.create_task(run_event(evt, ctx, start, dev if isinstance(dev, Prefetch) else None, name))
+
+    async def _display_task(self):
+        import uasyncio as asyncio
+        from display import DISPLAY
+
+        display_hist = TIMING.histogram('display')
+        sflag = False
+        hflag = False
+        while 1:
+            st = ticks_us()
+            DISPLAY.header(*self._make_header(sflag, hflag))
+            if display_hist is not None:
+                display_hist.add(ticks_diff(ticks_us(), st))
+            sflag = not sflag
+            if self._hb_lost:
+                hflag = not hflag
+            await asyncio.sleep_ms(250)
+
+    def _storage_task(self):
+        if self._downlink:
+            self._downlink.flush()
+        drain_all(OPEN_FILES, self._drain_us)
+
+    def _check_heartbeat(self):
+        if millis() - self._last_hb > HEARTBEAT_TIMEOUT:
+            self._hb_lost = True
+            if self._hbwtim is None:
+                wl = self._warning_led
+                self._hbwtim = Timer(HEARTBEAT_TIMER, freq=10)
+                self._hbwtim.callback(lambda t: wl.toggle())
+        elif self._hbwtim:
+            self._hb_lost = False
+            self._warning_led.off()
+            self._hbwtim.callback(None)
+            self._hbwtim = None
+            # autopilot may have rebooted and forgotten our rates
+            self._request_rates()
+
+    def _handle_messages(self, msgs, ctx):
+        for msg in msgs:
+            mid = msg[0]
+            if mid == HEARTBEAT:
+                self._last_hb = millis()
+            elif mid == GLOBAL_POSITION_INT:
+                ctx['gps'] = msg[1]
+                relalt = abs(msg[1][4]-msg[1][3])
+                if relalt >1000: # 1 meter
+                    phase = PHASE_FLIGHT
+                    self._dome_pattern = DOME_FLIGHT_PATTERN
+                    self._tail_pattern = TAIL_FLIGHT_PATTERN
+                elif relalt > 500:
+                    phase = PHASE_LANDING
+                    self._tail_pattern = TAIL_LANDING_PATTERN
+                else:
+                    phase = PHASE_GROUND
+                    self._dome_pattern = DOME_GROUND_PATTERN
+                    self._tail_pattern = TAIL_GROUND_PATTERN
+
+                if phase != ctx.get('phase'):
+                    ctx['phase'] = phase
+                    for f in OPEN_FILES:
+                        f.phase_changed(phase)
+
+                self._update_rate_phase(phase, ctx)
+
+            elif mid == ATTITUDE:
+                ctx['attitude'] = msg[1]
+
+    def _update_rate_phase(self, phase, ctx):
+        """
+        hysteresis for the per phase sampling periods. ctx['rate_phase'] only follows
+        ctx['phase'] once the new phase has held for phase_hold ms, so an altitude
+        hovering around a threshold does not flip the rates back and forth
+        """
+        if 'rate_phase' not in ctx:
+            ctx['rate_phase'] = phase
+        elif phase == ctx['rate_phase']:
+            self._pending_phase = None
+        else:
+            now = millis()
+            if phase != self._pending_phase:
+                self._pending_phase = phase
+                self._pending_since = now
+            elif now - self._pending_since >= self._phase_hold:
+                ctx['rate_phase'] = phase
+                self._pending_phase = None
+                LOG.info('mpsp', 'sampling rates for phase {}', phase)
+
+    def _make_scheduler(self, start):
+        sched = Scheduler()
+        for evt, name, dev in self._events:
+            sched.add(evt, name, start)
+        return sched
+
+    def _request_rates(self):
+        self._mavlink.request_rates(self._message_rates, self._data_streams)
+
     def _led_cb(self, timer):
         # status
         # status_cnt = self._status_cnt
@@ -290,34 +491,75 @@ class MPSP:
         self._cleanup()
 
     def _cleanup(self):
+        if self._mavlink:
+            self._mavlink.deinit()
         self._warning_led.off()
         self._led_timer.callback(None)
         self._spi1.write(TAIL_CLEAR[0])
         self._dome_led.low()
 
     def _create_device_event(self, dev, eid):
+        """
+        returns (event, device) or None
+        """
         klass = dev['klass']
         # name = dev.get('name', klass)
+        priority = PRIORITIES[dev.get('priority', 'normal')]
+        periods = self._phase_periods(dev, 'phase_periods')
+        sample_periods = self._phase_periods(dev, 'phase_sample_periods')
+
+        trigger = dev.get('trigger')
+        if trigger:
+            # sample by distance travelled (metres) instead of by time
+            trigger = DistanceTrigger(trigger.get('horizontal', 0), trigger.get('vertical', 0))
+            if self._mode != FLIGHT:
+                LOG.warning('mpsp', '{} distance trigger needs GLOBAL_POSITION_INT, only in flight mode', klass)
         factory = None
         if klass == 'DHT22':
             def factory():
                 from mpsp.drivers.dht import DHT22
                 d = DHT22(data_pin=dev.get('data_pin', 'Y2'))
-                return dht_event(d, eid, dev.get('period', 1000), self._oled_enabled)
+                return d, dht_event, 1000
         elif klass == 'DS18X20':
             def factory():
                 from mpsp.drivers.ds18x20 import DS18X20
                 d = DS18X20(dev.get('data_pin', 'Y3'))
-                return ds18x20_event(d, eid, dev.get('period', 1000), self._oled_enabled)
+                return d, ds18x20_event, 1000
         elif klass == 'ADS1115':
             def factory():
                 from mpsp.drivers.ads1x15 import ADS1115
                 i2c = I2C(dev.get('bus', 1), I2C.MASTER)
                 d = ADS1115(i2c)
-                return ads1115_event(d, eid, dev.get('period', 250), self._oled_enabled)
+                return d, ads1115_event, 250
 
         if factory:
-            dd = factory()
-            return dd
+            d, make_event, period = factory()
+            if self._runtime == ASYNC and hasattr(d, 'get_measurement_async'):
+                from mpsp.aio import Prefetch
+                d = Prefetch(d)
+            return make_event(d, eid, dev.get('period', period), self._oled_enabled, priority,
+                              sample_period=dev.get('sample_period', 0),
+                              periods=periods,
+                              trigger=trigger,
+                              sample_periods=sample_periods), d
+
+    def _phase_periods(self, dev, key):
+        """
+        {phase: period} from a {"ground": ms, "landing": ms, "flight": ms} entry of a
+        device, None if there is none. unknown phase names are logged and ignored
+        """
+        periods = dev.get(key)
+        if not periods:
+            return
+
+        out = {}
+        for k, v in periods.items():
+            phase = PHASES.get(k)
+            if phase is None:
+                LOG.error('mpsp', '{} {}: unknown phase "{}", expected one of {}',
+                          dev['klass'], key, k, ', '.join(PHASES))
+            else:
+                out[phase] = v
+        return out or None
 
 # ============= EOF =============================================
@@ -0,0 +1,200 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+fixed layout binary data log, written by the board. the host side reader is
+tools/mpsp_readers.py.
+
+a file starts with MAGIC and a version byte, followed by records. the first
+byte of every record is its tag
+
+    TAG_SCHEMA  <BBH tag, device tag, body length> body
+                body is "name\\tvalue code\\tfield,field,..." and declares the
+                layout of the device tag's samples. a tag may be redeclared
+    TAG_GPS     <BIiiii tag, GPS_BOOT_TIME, LAT, LON, ALT, REL_ALT>
+                written only when a new position arrived since the last one
+    device tag  <BI tag, sample millis> followed by one value per field
+                packed with the declared value code
+    DELTA|tag   delta of a record against the previous one with the same tag:
+                tag, then zigzag varints of the differences (millis first for
+                samples). float values are differenced as their int32 bit
+                patterns so the decoder reproduces them exactly
+
+this module must not import pyb
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import struct
+# ============= local library imports  ==========================
+
+MAGIC = b'MPSB'
+VERSION = 1
+
+TAG_SCHEMA = 0
+TAG_GPS = 1
+FIRST_DEVICE_TAG = 2
+
+SCHEMA_FORMAT = '<BBH'
+SCHEMA_LEN = 4
+GPS_FORMAT = '<BIiiii'
+GPS_LEN = 21
+GPS_FIELDS = ('GPS_BOOT_TIME', 'LAT', 'LON', 'ALT', 'REL_ALT')
+SAMPLE_PREFIX = '<BI'
+SAMPLE_PREFIX_LEN = 5
+
+DELTA = 0x80
+TAG_GPS_DELTA = DELTA | TAG_GPS
+# value codes that can be delta encoded, f goes through its bit pattern
+DELTA_CODES = 'bBhHiIlLf'
+
+
+def as_values(m):
+    """
+    normalize a device measurement (number, sequence or csv string) to a sequence of numbers
+    """
+    if isinstance(m, str):
+        return [float(v) for v in m.split(',')]
+    elif isinstance(m, (list, tuple)):
+        return m
+    return (m,)
+
+
+def file_header():
+    return MAGIC + bytes((VERSION,))
+
+
+def sample_format(code, n):
+    return '{}{}'.format(SAMPLE_PREFIX, code * n)
+
+
+def delta_format(code, n):
+    """
+    format that unpacks a packed sample as integers, None if code can not be delta encoded
+    """
+    if code not in DELTA_CODES:
+        return
+    return sample_format('i' if code == 'f' else code, n)
+
+
+def put_varint(buf, i, v):
+    """
+    zigzag encode the signed integer v into buf at i. returns the next index
+    """
+    v = (v << 1) if v >= 0 else ((-v << 1) - 1)
+    while v > 0x7F:
+        buf[i] = (v & 0x7F) | 0x80
+        v >>= 7
+        i += 1
+    buf[i] = v
+    return i + 1
+
+
+class RecordEncoder:
+    """
+    packs records into a preallocated scratch buffer. the memoryview returned by
+    each call is only valid until the next call.
+
+    with ``keyframe`` > 0 samples and positions are delta encoded against the
+    previous record of the same tag, and every keyframe-th record, or any record
+    encoded with key=True, is written in full
+    """
+
+    def __init__(self, size=256, keyframe=0):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._gps = None
+        self._formats = {}
+        self._keyframe = keyframe
+        # tag -> [previous millis, previous values as ints, records since the last key]
+        self._last = {}
+
+    def reset(self):
+        """
+        forget the last position and every delta base, the next records are written in full
+        """
+        self._gps = None
+        self._last = {}
+
+    def schema(self, tag, name, code, fields):
+        body = '{}\t{}\t{}'.format(name, code, ','.join(fields)).encode()
+        fmt = sample_format(code, len(fields))
+        self._formats[tag] = (fmt, struct.calcsize(fmt), delta_format(code, len(fields)))
+        self._last.pop(tag, None)
+        return struct.pack(SCHEMA_FORMAT, TAG_SCHEMA, tag, len(body)) + body
+
+    def gps(self, gps, key=False):
+        """
+        returns None if gps is the same tuple object that was encoded last,
+        unless key is set
+        """
+        if gps is None or (gps is self._gps and not key):
+            return
+
+        self._gps = gps
+        if self._keyframe:
+            last = self._last.get(TAG_GPS)
+            if self._is_delta(last, key):
+                buf = self._buffer
+                buf[0] = TAG_GPS_DELTA
+                i = 1
+                lv = last[1]
+                for j in range(5):
+                    i = put_varint(buf, i, gps[j] - lv[j])
+                self._rebase(TAG_GPS, last, 0, gps)
+                return self._view[0:i]
+            self._rebase(TAG_GPS, None, 0, gps)
+
+        struct.pack_into(GPS_FORMAT, self._buffer, 0, TAG_GPS, gps[0], gps[1], gps[2], gps[3], gps[4])
+        return self._view[0:GPS_LEN]
+
+    def sample_size(self, tag):
+        return self._formats[tag][1]
+
+    def sample(self, tag, t, values, key=False):
+        fmt, n, dfmt = self._formats[tag]
+        buf = self._buffer
+        struct.pack_into(fmt, buf, 0, tag, t, *values)
+        if not self._keyframe or dfmt is None:
+            return self._view[0:n]
+
+        ivalues = struct.unpack_from(dfmt, buf, 0)
+        last = self._last.get(tag)
+        if not self._is_delta(last, key):
+            self._rebase(tag, None, t, ivalues)
+            return self._view[0:n]
+
+        buf[0] = DELTA | tag
+        i = put_varint(buf, 1, t - last[0])
+        lv = last[1]
+        for j in range(2, len(ivalues)):
+            i = put_varint(buf, i, ivalues[j] - lv[j])
+        self._rebase(tag, last, t, ivalues)
+        return self._view[0:i]
+
+    def _is_delta(self, last, key):
+        return last is not None and not key and last[2] < self._keyframe
+
+    def _rebase(self, tag, last, t, values):
+        """
+        make values the base of the tag's next delta. last is None after a full record
+        """
+        if last is None:
+            self._last[tag] = [t, values, 1]
+        else:
+            last[0] = t
+            last[1] = values
+            last[2] += 1
+
+# ============= EOF =============================================
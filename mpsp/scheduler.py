@@ -0,0 +1,122 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from pyb import millis, wfi
+# ============= local library imports  ==========================
+from mpsp.log import LOG
+
+DUE = const(0)
+FUNC = const(1)
+NAME = const(2)
+RUNS = const(3)
+LATE_SUM = const(4)
+LATE_MAX = const(5)
+SKIPPED = const(6)
+
+
+class Scheduler:
+    """
+    deadline driven dispatch for event_wrapper events.
+
+    events are kept ordered by their next due time. ``run`` calls every event
+    that is due as func(ctx, due); the event returns its next due time. an event
+    that fell more than a whole period behind skips the missed runs instead of
+    bursting to catch up. ``idle`` sleeps until the next interrupt (SysTick, the
+    UART receive timer, ...) when nothing is due.
+
+    for every event the scheduler counts runs, skipped periods and how many ms
+    it ran late
+    """
+
+    def __init__(self):
+        # [due, func, name, runs, late sum, late max, skipped] sorted by due
+        self._events = []
+
+    def add(self, func, name, due=None):
+        if due is None:
+            due = millis()
+        self._insert([due, func, name, 0, 0, 0, 0])
+
+    def next_due(self):
+        if self._events:
+            return self._events[0][DUE]
+
+    def run(self, ctx):
+        """
+        call everything that is due. returns the number of events run
+        """
+        events = self._events
+        n = 0
+        while events:
+            now = millis()
+            e = events[0]
+            due = e[DUE]
+            if due > now:
+                break
+
+            events.pop(0)
+            late = now - due
+            e[RUNS] += 1
+            e[LATE_SUM] += late
+            if late > e[LATE_MAX]:
+                e[LATE_MAX] = late
+
+            nxt = e[FUNC](ctx, due)
+            if nxt is None or nxt <= due:
+                # not a scheduled event, try again on the next pass
+                nxt = now + 1
+            elif nxt <= now:
+                period = nxt - due
+                skip = (now - due) // period
+                e[SKIPPED] += skip
+                nxt += skip * period
+
+            e[DUE] = nxt
+            self._insert(e)
+            n += 1
+        return n
+
+    def idle(self):
+        """
+        sleep until the next interrupt unless something is already due
+        """
+        events = self._events
+        if not events or events[0][DUE] > millis():
+            wfi()
+
+    def stats(self):
+        """
+        [(name, runs, mean late ms, max late ms, skipped), ...]
+        """
+        return [(e[NAME], e[RUNS], e[LATE_SUM] / e[RUNS] if e[RUNS] else 0, e[LATE_MAX], e[SKIPPED])
+                for e in self._events]
+
+    def report(self):
+        for name, runs, mean, mx, skipped in self.stats():
+            LOG.info('scheduler', '{} runs={} late mean={:0.1f}ms max={}ms skipped={}',
+                     name, runs, mean, mx, skipped)
+
+    def _insert(self, e):
+        events = self._events
+        due = e[DUE]
+        i = len(events)
+        while i and events[i - 1][DUE] > due:
+            i -= 1
+        events.insert(i, e)
+
+# ============= EOF =============================================
@@ -0,0 +1,96 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+persistent session index, written by the board and read on the host by
+tools/mpsp_readers.py.
+
+the index is a fixed size header followed by an append only list of records
+
+    header          <4sBI MAGIC, version, next session number>
+    REC_SESSION     <BII kind, session, start time (RTC seconds since 2000-01-01)>
+    REC_FILE        <BIIIH kind, session, opened at (millis), size, path length> path
+    REC_END         <BII kind, session, duration (ms)>
+
+a file is listed again with its final size when the session ends, readers keep
+the last size seen for a path. starting a session only reads and rewrites the
+header and appends one record, whatever the number of flights on the card
+
+this module must not import pyb
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import struct
+# ============= local library imports  ==========================
+
+MAGIC = b'MPSI'
+VERSION = 1
+
+HEADER_FORMAT = '<4sBI'
+HEADER_LEN = 9
+
+REC_SESSION = 1
+REC_FILE = 2
+REC_END = 3
+
+SESSION_FORMAT = '<BII'
+SESSION_LEN = 9
+FILE_FORMAT = '<BIIIH'
+FILE_LEN = 15
+END_FORMAT = '<BII'
+END_LEN = 9
+
+
+class SessionIndex:
+    """
+    board side writer. ``begin`` allocates the next session number. ``first`` seeds
+    the counter when the index is created on a card that already holds data
+    """
+
+    def __init__(self, path, first=1):
+        self.path = path
+        self.session = None
+        try:
+            with open(path, 'rb') as rfile:
+                magic, version, nxt = struct.unpack(HEADER_FORMAT, rfile.read(HEADER_LEN))
+            if magic != MAGIC:
+                raise ValueError('not an MPSP session index')
+        except OSError:
+            nxt = first
+            with open(path, 'wb') as wfile:
+                wfile.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, nxt))
+        self._next = nxt
+
+    def begin(self, start):
+        n = self._next
+        self._next = n + 1
+        with open(self.path, 'r+b') as wfile:
+            wfile.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, self._next))
+        self._append(struct.pack(SESSION_FORMAT, REC_SESSION, n, start))
+        self.session = n
+        return n
+
+    def add_file(self, path, opened, size=0):
+        p = path.encode()
+        self._append(struct.pack(FILE_FORMAT, REC_FILE, self.session, opened, size, len(p)) + p)
+
+    def end(self, duration):
+        self._append(struct.pack(END_FORMAT, REC_END, self.session, duration))
+
+    def _append(self, rec):
+        with open(self.path, 'ab') as wfile:
+            wfile.write(rec)
+
+# ============= EOF =============================================
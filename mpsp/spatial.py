@@ -0,0 +1,116 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+distance triggered sampling.
+
+positions are GLOBAL_POSITION_INT tuples (time_boot_ms, lat, lon, alt,
+relative_alt) with lat/lon in 1e-7 degrees and altitudes in mm. the
+horizontal distance uses small int arithmetic only: an equirectangular
+projection, with cos(lat) taken once per reference point, and
+max + 3/8 min in place of the hypotenuse (within about 7%). differences are
+clamped to CLAMP (about 5.8 km) first so no product outgrows a MicroPython
+small int, a larger move reads as about 5.8 km. longitude differences wrap
+at +-180 degrees
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from math import cos, radians
+# ============= local library imports  ==========================
+
+# cm per 1e-7 degree of latitude, scaled by 2**8 (1.11328)
+CM_PER_E7 = const(285)
+CM_SHIFT = const(8)
+COS_SHIFT = const(10)
+# largest difference in 1e-7 degrees used, keeps every product below 2**30
+CLAMP = const(524288)
+HALF_TURN = 1800000000
+TURN = 3600000000
+
+
+def cos_scale(lat):
+    """
+    cos(lat) scaled by 2**10 for a latitude in 1e-7 degrees
+    """
+    return int(cos(radians(lat / 1e7)) * (1 << COS_SHIFT))
+
+
+def horizontal_cm(lat0, lon0, lat1, lon1, coslat):
+    """
+    approximate horizontal distance in cm. coslat is cos_scale(lat0)
+    """
+    dlon = lon1 - lon0
+    if dlon > HALF_TURN:
+        dlon -= TURN
+    elif dlon < -HALF_TURN:
+        dlon += TURN
+
+    dy = min(abs(lat1 - lat0), CLAMP) * CM_PER_E7 >> CM_SHIFT
+    dx = (min(abs(dlon), CLAMP) * CM_PER_E7 >> CM_SHIFT) * coslat >> COS_SHIFT
+    if dx < dy:
+        dx, dy = dy, dx
+    return dx + (dy * 3 >> 3)
+
+
+class DistanceTrigger:
+    """
+    call with the latest position, returns True when the vehicle has moved at
+    least ``horizontal`` or ``vertical`` metres (0 disables the axis) since the
+    last time it returned True. the first position always triggers.
+
+    ``stale`` tells when the position stopped updating, without it a trigger
+    would silently never fire again
+    """
+    _ref = None
+    _coslat = 0
+    _seen = None
+    _seen_at = 0
+    _warned = False
+
+    def __init__(self, horizontal=0, vertical=0, stale_ms=3000):
+        self._h = int(horizontal * 100)
+        self._v = int(vertical * 1000)
+        self._stale_ms = stale_ms
+
+    def __call__(self, gps):
+        if gps is None:
+            return False
+
+        ref = self._ref
+        if ref is not None:
+            if not (self._v and abs(gps[3] - ref[3]) >= self._v):
+                if not (self._h and horizontal_cm(ref[1], ref[2], gps[1], gps[2], self._coslat) >= self._h):
+                    return False
+
+        self._coslat = cos_scale(gps[1])
+        self._ref = gps
+        return True
+
+    def stale(self, gps, now):
+        """
+        returns True once when gps (ctx['gps'], replaced by every
+        GLOBAL_POSITION_INT) has not changed for stale_ms, again only after it
+        updated in between
+        """
+        if gps is not self._seen:
+            self._seen = gps
+            self._seen_at = now
+            self._warned = False
+        elif not self._warned and now - self._seen_at > self._stale_ms:
+            self._warned = True
+            return True
+        return False
+
+# ============= EOF =============================================
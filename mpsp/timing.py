@@ -0,0 +1,164 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+ticks_us based timing histograms.
+
+every histogram has a fixed number of log2 buckets, bucket 0 counts values
+below 64us, bucket i values from 64 * 2**(i-1)us up, the last bucket
+everything above. exec histograms hold how long a call took, period
+histograms how far the actual period was from the configured one (negative
+is early). memory does not grow with the run time
+
+    from mpsp.timing import TIMING
+    TIMING.dump()       # from the REPL
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from array import array
+# ============= local library imports  ==========================
+from mpsp.log import LOG
+
+SHIFT = const(6)
+
+
+class Histogram:
+    def __init__(self, name, expected=0, buckets=16):
+        self.name = name
+        # configured period in us, 0 for exec histograms
+        self.expected = expected
+        self.counts = array('L', [0] * buckets)
+        self.n = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def add(self, v):
+        if self.n:
+            if v < self.min:
+                self.min = v
+            elif v > self.max:
+                self.max = v
+        else:
+            self.min = v
+            self.max = v
+        self.n += 1
+        self.total += v
+
+        a = (v if v >= 0 else -v) >> SHIFT
+        i = 0
+        last = len(self.counts) - 1
+        while a and i < last:
+            a >>= 1
+            i += 1
+        self.counts[i] += 1
+
+    def percentile(self, p):
+        """
+        upper bound in us of the bucket holding the p-th percentile of abs(value)
+        """
+        if not self.n:
+            return 0
+        k = self.n * p / 100
+        c = 0
+        for i, ci in enumerate(self.counts):
+            c += ci
+            if c >= k:
+                break
+        return 1 << (i + SHIFT)
+
+    def stats(self):
+        """
+        (name, expected, n, mean, min, max, p50, p99)
+        """
+        n = self.n
+        return (self.name, self.expected, n, self.total // n if n else 0, self.min, self.max,
+                self.percentile(50), self.percentile(99))
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.n = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+
+class Timing:
+    enabled = True
+
+    def __init__(self, buckets=16):
+        self.buckets = buckets
+        self._hists = []
+
+    def configure(self, enabled=None, buckets=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if buckets is not None:
+            self.buckets = buckets
+
+    def histogram(self, name, expected=0):
+        """
+        the Histogram called name, created on first use. None when timing is
+        disabled, callers skip their measurements then
+        """
+        if not self.enabled:
+            return
+
+        for h in self._hists:
+            if h.name == name:
+                return h
+
+        h = Histogram(name, expected, self.buckets)
+        self._hists.append(h)
+        return h
+
+    def stats(self):
+        return [h.stats() for h in self._hists]
+
+    def lines(self):
+        yield 'name,expected_us,n,mean_us,min_us,max_us,p50_us,p99_us,buckets'
+        for h in self._hists:
+            yield '{},{}'.format(','.join(map(str, h.stats())), ' '.join(map(str, h.counts)))
+
+    def dump(self):
+        """
+        print every histogram. blocks on the console, meant for the REPL
+        """
+        for line in self.lines():
+            print(line)
+
+    def report(self):
+        for name, expected, n, mean, mn, mx, p50, p99 in self.stats():
+            LOG.info('timing', '{} n={} mean={}us min={}us max={}us p50<{}us p99<{}us',
+                     name, n, mean, mn, mx, p50, p99)
+
+    def write(self, path):
+        """
+        write the summary as csv, one row per histogram
+        """
+        with open(path, 'w') as wfile:
+            for line in self.lines():
+                wfile.write(line)
+                wfile.write('\n')
+
+    def reset(self):
+        for h in self._hists:
+            h.reset()
+
+
+TIMING = Timing()
+
+# ============= EOF =============================================
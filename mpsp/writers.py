@@ -0,0 +1,546 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+from pyb import millis
+from utime import ticks_us, ticks_diff
+# ============= local library imports  ==========================
+from mpsp.records import RecordEncoder, FIRST_DEVICE_TAG, TAG_GPS, GPS_LEN, as_values, file_header
+from mpsp import journal
+from mpsp.log import LOG
+
+SECTOR = const(512)
+
+# write priorities. LOW data is shed above the high water mark, HIGH data (headers,
+# schemas) only fails when the ring is completely full
+LOW = 0
+NORMAL = 1
+HIGH = 2
+PRIORITIES = {'low': LOW, 'normal': NORMAL, 'high': HIGH}
+
+
+def segment_path(path, n):
+    """
+    /sd/mpsp_data/dht/000012.bin -> /sd/mpsp_data/dht/000012_003.bin
+    """
+    i = path.rfind('.')
+    return '{}_{:03n}{}'.format(path[:i], n, path[i:])
+
+
+class LogWriter:
+    """
+    keeps a data file open and collects rows in a preallocated, sector aligned RAM ring.
+
+    ``write`` only copies into the ring, it never touches the card. ``drain`` is
+    called from the main loop when it has slack and writes whole 512 byte
+    sectors until its time budget is used up, so every card write is sector
+    aligned and an SD housekeeping stall delays a drain instead of a sample.
+    ``drain`` also syncs the FAT metadata every ``flush_interval`` ms and after a
+    flight phase change if ``flush_on_phase`` is set. the partial last sector is
+    only written by ``flush``/``close``.
+
+    above ``high_water`` (fraction of the ring) LOW priority writes are dropped,
+    or if ``decimate`` is set only every decimate-th one is kept. a write that
+    does not fit at all is an overrun. card writes slower than ``stall_threshold`` ms
+    are counted as stalls. a card write or sync that raises OSError is counted
+    in ``write_errors`` and logged, the unwritten sectors stay in the ring and
+    are retried by the next ``drain``, so a failing card sheds samples through
+    overruns instead of stopping the loop.
+
+    with ``segment_size`` (bytes) or ``segment_ms`` set the log is split into
+    bounded segment files named by ``segment_path``. ``drain`` rotates once
+    ``rotate_due``, between records and outside the sampling path: the current
+    segment is flushed and closed, the next one opened and every hook added with
+    ``add_rotate_hook`` is called as hook(writer, (old path, old opened, old
+    size)) so it can restart its headers. a segment may overshoot segment_size
+    by what the ring held when it was rotated.
+
+    with ``preallocate`` each segment's clusters are allocated when it is
+    opened, so appends never extend the FAT chain. the file then keeps its
+    preallocated length and FatFs does not zero the extension, so the tail holds
+    whatever was on the card before. only journaled logs, whose blocks are
+    checked by crc, are preallocated. ``size`` is the number of bytes actually
+    logged.
+
+    with ``journal`` = (session, stream) writes are packed into mpsp.journal
+    blocks instead, one per sector, each with a sequence number and crc. a block
+    is sealed into the ring when the next write does not fit. a sync writes the
+    open block as it is, sealed, in place: the file position stays at its start,
+    so each sync rewrites the same sector with the same sequence number until
+    the block is full. after a brown out everything up to the last sync can be
+    recovered block by block (tools/mpsp_export.py recover) without a sync
+    costing a sector
+    """
+    overruns = 0
+    decimated = 0
+    stalls = 0
+    stall_ms = 0
+    max_stall_ms = 0
+    write_errors = 0
+
+    def __init__(self, path, mode='wb', buffer_size=8192, flush_interval=5000, flush_on_phase=True,
+                 high_water=0.75, decimate=0, stall_threshold=50,
+                 segment_size=0, segment_ms=0, preallocate=False, journal=None):
+        self._base = path
+        self._mode = mode
+        self._segment_size = segment_size
+        self._segment_ms = segment_ms
+        # stale card contents in the preallocated tail are only safe behind block crcs
+        self._preallocate = preallocate and segment_size and journal is not None
+        self._rotate_hooks = []
+        self.segment = 0
+        size = (buffer_size + SECTOR - 1) // SECTOR * SECTOR
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._size = size
+        self._head = 0
+        self._used = 0
+        self._high_water = int(size * high_water)
+        self._decimate = decimate
+        self._decimate_cnt = 0
+        self._stall_threshold = stall_threshold
+        self._flush_interval = flush_interval
+        self._flush_on_phase = flush_on_phase
+        self._sync_pending = False
+        self._last_flush = millis()
+        self._journal = journal
+        if journal is not None:
+            self._block = bytearray(SECTOR)
+            self._block_view = memoryview(self._block)
+            self._zeros = memoryview(bytearray(SECTOR))
+            self._bn = 0
+            self.seq = 0
+        self._open()
+
+    def admit(self, n, priority=NORMAL):
+        """
+        returns True if n bytes at priority can go into the ring
+        """
+        if self._journal is not None:
+            # only a write that seals the current block takes ring space
+            n = SECTOR if self._bn + n > journal.PAYLOAD_LEN else 0
+
+        used = self._used
+        if used + n > self._size:
+            self.overruns += 1
+            return False
+
+        if priority == LOW and used > self._high_water:
+            self._decimate_cnt += 1
+            if not self._decimate or self._decimate_cnt % self._decimate:
+                self.decimated += 1
+                return False
+        return True
+
+    def write(self, data, priority=NORMAL):
+        """
+        copy data into the ring. returns False if it was dropped
+        """
+        if isinstance(data, str):
+            data = data.encode()
+
+        n = len(data)
+        if self._journal is not None:
+            return self._journal_write(data, n, priority)
+
+        if not self.admit(n, priority):
+            return False
+
+        self._put(data, n)
+        self.size += n
+        return True
+
+    def _journal_write(self, data, n, priority):
+        if n > journal.PAYLOAD_LEN:
+            self.overruns += 1
+            return False
+
+        if not self.admit(n, priority):
+            return False
+
+        bn = self._bn
+        if bn + n > journal.PAYLOAD_LEN:
+            self._seal()
+            bn = 0
+
+        s = journal.HEADER_LEN + bn
+        self._block[s:s + n] = data
+        self._bn = bn + n
+        return True
+
+    def _seal(self):
+        """
+        close the current journal block and move it into the ring
+        """
+        bn = self._bn
+        if not bn:
+            return
+
+        s = journal.HEADER_LEN + bn
+        self._block_view[s:SECTOR] = self._zeros[s:SECTOR]
+        session, stream = self._journal
+        journal.seal(self._block, session, stream, self.seq, bn)
+        self._put(self._block, SECTOR)
+        self.size += SECTOR
+        self.seq += 1
+        self._bn = 0
+
+    def _put(self, data, n):
+        size = self._size
+        tail = (self._head + self._used) % size
+        k = size - tail
+        if n <= k:
+            self._buffer[tail:tail + n] = data
+        else:
+            # wrap around the end of the ring
+            data = memoryview(data)
+            self._buffer[tail:size] = data[0:k]
+            self._buffer[0:n - k] = data[k:n]
+        self._used += n
+
+    def seal(self):
+        """
+        end the current journal block so the next write starts a new one.
+        returns False if the ring has no room for it
+        """
+        if not self._bn:
+            return True
+        if self._used + SECTOR > self._size:
+            self.overruns += 1
+            return False
+        self._seal()
+        return True
+
+    def block(self, n):
+        """
+        sequence number of the journal block the next write of n bytes lands in,
+        None if the log is not journaled
+        """
+        if self._journal is None:
+            return
+        if self._bn and self._bn + n > journal.PAYLOAD_LEN:
+            return self.seq + 1
+        return self.seq
+
+    def rotate_due(self):
+        if self._segment_size and self.size >= self._segment_size:
+            return True
+        return self._segment_ms and millis() - self.opened >= self._segment_ms
+
+    def add_rotate_hook(self, hook):
+        self._rotate_hooks.append(hook)
+
+    def rotate(self):
+        """
+        close the current segment and start the next one
+        """
+        old = (self.path, self.opened, self.size)
+        self.flush()
+        self._file.close()
+        self.segment += 1
+        self._open()
+        for hook in self._rotate_hooks:
+            hook(self, old)
+
+    def sync_due(self):
+        return self._sync_pending or \
+            (self._flush_interval and millis() - self._last_flush > self._flush_interval)
+
+    def drain(self, max_us=5000, st=None):
+        """
+        write whole sectors until max_us have elapsed since st (ticks_us, default
+        now). a due sync or segment rotation is always done. returns the number
+        of sectors written
+        """
+        if st is None:
+            st = ticks_us()
+        sync = self.sync_due()
+
+        n = 0
+        while self._used >= SECTOR and (sync or ticks_diff(ticks_us(), st) < max_us):
+            if not self._write_sector():
+                # the card is failing, try again next time
+                return n
+            n += 1
+
+        if sync:
+            if self._journal is not None and self._bn and not self._write_open_block():
+                return n
+            self._sync()
+
+        if self.rotate_due():
+            try:
+                self.rotate()
+            except OSError as e:
+                self._write_error(e)
+        return n
+
+    def flush(self):
+        """
+        write everything, including a partial last sector, and sync
+        """
+        while self._used >= SECTOR:
+            if not self._write_sector():
+                return
+
+        if self._journal is not None and self._bn:
+            self._seal()
+            if not self._write_sector():
+                return
+
+        used = self._used
+        if used:
+            head = self._head
+            k = min(used, self._size - head)
+            try:
+                self._file.write(self._view[head:head + k])
+                if k < used:
+                    self._file.write(self._view[0:used - k])
+            except OSError as e:
+                self._write_error(e)
+                return
+            # empty again, restart at the beginning so sectors stay aligned
+            self._head = 0
+            self._used = 0
+        self._sync()
+
+    def phase_changed(self, phase):
+        if self._flush_on_phase:
+            self._sync_pending = True
+
+    def stats(self):
+        return self.overruns, self.decimated, self.stalls, self.max_stall_ms, self.stall_ms, self.write_errors
+
+    def close(self):
+        self.flush()
+        try:
+            self._file.close()
+        except OSError as e:
+            self._write_error(e)
+        LOG.info('writer', '{} overruns={} decimated={} stalls={} max_stall={}ms stall={}ms write_errors={}',
+                 self.path, *self.stats())
+
+    def _open(self):
+        path = self._base
+        if self._segment_size or self._segment_ms:
+            path = segment_path(path, self.segment)
+
+        self.path = path
+        self._file = open(path, self._mode)
+        if self._preallocate:
+            st = millis()
+            self._file.seek(self._segment_size - 1)
+            self._file.write(b'\0')
+            self._file.flush()
+            self._file.seek(0)
+            self._stall(millis() - st)
+
+        self.opened = millis()
+        self.size = 0
+
+    def _write_sector(self):
+        """
+        write the sector at the head of the ring. returns False if the card
+        failed, the sector then stays in the ring
+        """
+        head = self._head
+        st = millis()
+        try:
+            self._file.write(self._view[head:head + SECTOR])
+        except OSError as e:
+            self._write_error(e)
+            return False
+        self._stall(millis() - st)
+        self._head = (head + SECTOR) % self._size
+        self._used -= SECTOR
+        return True
+
+    def _write_open_block(self):
+        """
+        write the open journal block sealed at the current file position and
+        seek back to its start. only called with the ring drained, so that is
+        where the block goes once it is full
+        """
+        bn = self._bn
+        s = journal.HEADER_LEN + bn
+        self._block_view[s:SECTOR] = self._zeros[s:SECTOR]
+        session, stream = self._journal
+        journal.seal(self._block, session, stream, self.seq, bn)
+
+        f = self._file
+        st = millis()
+        try:
+            pos = f.tell()
+            f.write(self._block)
+            f.seek(pos)
+        except OSError as e:
+            self._write_error(e)
+            return False
+        self._stall(millis() - st)
+        return True
+
+    def _sync(self):
+        st = millis()
+        try:
+            self._file.flush()
+        except OSError as e:
+            # stays pending, retried with the next drain
+            self._write_error(e)
+            return
+        self._stall(millis() - st)
+        self._last_flush = millis()
+        self._sync_pending = False
+
+    def _write_error(self, e):
+        self.write_errors += 1
+        LOG.warning('writer', '{} write failed ({}) errors={}', self.path, e, self.write_errors)
+
+    def _stall(self, et):
+        if et > self._stall_threshold:
+            self.stalls += 1
+            self.stall_ms += et
+        if et > self.max_stall_ms:
+            self.max_stall_ms = et
+
+
+_drain_first = [0]
+
+
+def drain_all(writers, max_us):
+    """
+    drain writers within one budget of max_us for all of them. the writer served
+    first moves on every call so a busy log can not starve the others
+    """
+    nw = len(writers)
+    if not nw:
+        return
+
+    st = ticks_us()
+    first = _drain_first[0] % nw
+    _drain_first[0] = first + 1
+    for i in range(nw):
+        writers[(first + i) % nw].drain(max_us, st)
+
+
+class RecordLog:
+    """
+    binary record stream (see mpsp.records) on top of a LogWriter.
+
+    a device's schema is written with its first sample, once the number of values
+    it returns is known, and redeclared if that number changes. records are packed
+    into the encoder's scratch buffer and copied straight into the writer's buffer.
+
+    with ``keyframe`` > 0 samples and positions are delta encoded (see
+    mpsp.records). on a journaled writer every block opens with the schema of
+    each declared device, and the first position and first sample of each tag in
+    it are written in full, so a block can still be decoded when the ones before
+    it are lost
+    """
+
+    def __init__(self, writer, keyframe=0):
+        self.writer = writer
+        self._encoder = RecordEncoder(keyframe=keyframe)
+        # tag -> journal block of the tag's last record
+        self._blocks = {}
+        # tag -> [name, value code, fields, declared count, schema record]
+        self._devices = {}
+        self._next_tag = FIRST_DEVICE_TAG
+        writer.write(file_header(), HIGH)
+        # journal block the schemas were last written to
+        self._block = writer.block(0)
+        writer.add_rotate_hook(self._rotated)
+
+    def add_device(self, name, code, fields):
+        tag = self._next_tag
+        self._next_tag += 1
+        self._devices[tag] = [name, code, fields.split(','), None, None]
+        return tag
+
+    def write(self, tag, t, gps, m, priority=NORMAL):
+        """
+        returns False if the writer shed the sample
+        """
+        values = as_values(m)
+        writer = self.writer
+        enc = self._encoder
+
+        dev = self._devices[tag]
+        n = len(values)
+        if dev[3] != n:
+            fields = dev[2]
+            if len(fields) != n:
+                fields = ['{}{}'.format(fields[0], i) for i in range(n)]
+            schema = enc.schema(tag, dev[0], dev[1], fields)
+            if not self._enter(len(schema)) or not writer.write(schema, HIGH):
+                # not declared, no sample may reference the tag yet. retried with the next sample
+                return False
+            dev[3] = n
+            dev[4] = schema
+
+        # sample and its position go in together or not at all
+        size = enc.sample_size(tag) + GPS_LEN
+        if not writer.admit(size, priority) or not self._enter(size):
+            return False
+
+        blocks = self._blocks
+        if gps is not None:
+            g = enc.gps(gps)
+            blk = writer.block(GPS_LEN if g is None else len(g))
+            if blk is not None and blocks.get(TAG_GPS) != blk:
+                # the block's first position, in full even if it did not change
+                g = enc.gps(gps, True)
+            if g is not None:
+                writer.write(g, HIGH)
+                blocks[TAG_GPS] = writer.block(0)
+
+        r = enc.sample(tag, t, values)
+        blk = writer.block(len(r))
+        if blk is not None and blocks.get(tag) != blk:
+            r = enc.sample(tag, t, values, True)
+        writer.write(r, HIGH)
+        blocks[tag] = writer.block(0)
+        return True
+
+    def _enter(self, n):
+        """
+        if the next n bytes start a new journal block, seal the current one and
+        open the next with the schemas of the declared devices. returns False if
+        the writer had no room
+        """
+        writer = self.writer
+        blk = writer.block(n)
+        if blk is None or blk == self._block:
+            return True
+
+        if not writer.seal():
+            return False
+        for dev in self._devices.values():
+            if dev[4] is not None:
+                writer.write(dev[4], HIGH)
+        self._block = writer.block(0)
+        return True
+
+    def _rotated(self, writer, old):
+        # every segment stands alone, redeclare the schemas and repeat the position
+        writer.write(file_header(), HIGH)
+        for dev in self._devices.values():
+            dev[3] = None
+            dev[4] = None
+        self._block = writer.block(0)
+        self._encoder.reset()
+
+# ============= EOF =============================================
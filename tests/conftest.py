@@ -0,0 +1,32 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+host tests for the log formats. the board modules run under CPython once
+MicroPython's const builtin is provided, the readers live in tools/
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import builtins
+import os
+import sys
+# ============= local library imports  ==========================
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tools')]
+
+if not hasattr(builtins, 'const'):
+    builtins.const = lambda x: x
+
+# ============= EOF =============================================
@@ -0,0 +1,141 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import io
+import os
+# ============= local library imports  ==========================
+from mpsp import journal
+from mpsp.records import RecordEncoder, file_header
+from mpsp_export import assemble, export_csv, open_log, main
+from mpsp_readers import check_block
+
+SESSION = 5
+STREAM = 1
+ROWS = 10
+
+
+def make_block(seq, payload):
+    block = bytearray(journal.BLOCK)
+    block[journal.HEADER_LEN:journal.HEADER_LEN + len(payload)] = payload
+    journal.seal(block, SESSION, STREAM, seq, len(payload))
+    return bytes(block)
+
+
+def position(seq):
+    return seq * 1000, 350000000 + seq, -1060000000 - seq, 1500000, 10000 + seq
+
+
+def journaled_log(nblocks, first=0):
+    """
+    blocks laid out like RecordLog writes them: each opens with the schema and
+    the position, its first sample is a key
+    """
+    enc = RecordEncoder(keyframe=4)
+    schema = bytes(enc.schema(2, 'ds', 'f', ['temp']))
+    blocks = []
+    for seq in range(first, first + nblocks):
+        payload = bytearray(file_header()) if seq == first else bytearray()
+        payload += schema
+        payload += enc.gps(position(seq), True)
+        for k in range(ROWS):
+            t = seq * ROWS + k
+            payload += enc.sample(2, t, (t * 0.5,), k == 0)
+        blocks.append(make_block(seq, payload))
+    return blocks
+
+
+def rows(seqs):
+    out = []
+    for seq in seqs:
+        gps = ','.join(map(str, position(seq)))
+        for k in range(ROWS):
+            t = seq * ROWS + k
+            out.append('{},{},{:.7g}'.format(t, gps, t * 0.5))
+    return out
+
+
+def scanned(blocks, lost=()):
+    return [(i * journal.BLOCK,) + check_block(b) for i, b in enumerate(blocks) if i not in lost]
+
+
+def csv_lines(src):
+    out = io.StringIO()
+    export_csv(src, out)
+    return out.getvalue().splitlines()
+
+
+def test_assemble_counts_lost_blocks():
+    blocks = journaled_log(6)
+    parts, missing = assemble(scanned(blocks))[(SESSION, STREAM)]
+    assert missing == 0
+    assert len(parts) == 1
+
+    assert assemble(scanned(blocks, (2, 4)))[(SESSION, STREAM)][1] == 2
+    # lost leading blocks count too
+    assert assemble(scanned(blocks, (0, 1)))[(SESSION, STREAM)][1] == 2
+
+
+def test_assemble_later_segment():
+    # a segment file further into the stream starts with its own file header
+    blocks = journaled_log(3, first=40)
+    assert assemble(scanned(blocks))[(SESSION, STREAM)][1] == 0
+    assert assemble(scanned(blocks, (0,)))[(SESSION, STREAM)][1] == 41
+
+
+def test_open_log_round_trip(tmp_path):
+    path = str(tmp_path / 'log.bin')
+    with open(path, 'wb') as wfile:
+        wfile.write(b''.join(journaled_log(4)))
+
+    with open_log(path) as src:
+        lines = csv_lines(src)
+    assert lines[0] == 'MS,GPS_BOOT_TIME,LAT,LON,ALT,REL_ALT,temp'
+    # the schema repeated in every block does not repeat the header row
+    assert lines[1:] == rows(range(4))
+
+
+def test_open_log_lost_blocks(tmp_path):
+    blocks = journaled_log(5)
+    for i in (0, 3):
+        blocks[i] = bytes(journal.BLOCK)
+    path = str(tmp_path / 'log.bin')
+    with open(path, 'wb') as wfile:
+        wfile.write(b''.join(blocks))
+
+    with open_log(path) as src:
+        lines = csv_lines(src)
+    assert lines[1:] == rows((1, 2, 4))
+
+
+def test_recover(tmp_path):
+    blocks = journaled_log(5)
+    blocks[0] = b'\xff' * journal.BLOCK
+    image = str(tmp_path / 'card.img')
+    with open(image, 'wb') as wfile:
+        wfile.write(b'\0' * 3 * journal.BLOCK + b''.join(blocks))
+
+    out = str(tmp_path / 'recovered')
+    main(['recover', image, '-o', out])
+
+    assert os.listdir(out) == ['000005_01_000.bin']
+    with open(os.path.join(out, '000005_01_000.bin'), 'rb') as src:
+        assert src.read(4) == file_header()[:4]
+        src.seek(0)
+        assert csv_lines(src)[1:] == rows(range(1, 5))
+
+# ============= EOF =============================================
@@ -0,0 +1,70 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import io
+# ============= local library imports  ==========================
+from mpsp import journal
+from mpsp_readers import check_block, scan_journal
+
+
+def make_block(session, stream, seq, payload):
+    block = bytearray(journal.BLOCK)
+    block[journal.HEADER_LEN:journal.HEADER_LEN + len(payload)] = payload
+    journal.seal(block, session, stream, seq, len(payload))
+    return block
+
+
+def test_seal_check_round_trip():
+    block = make_block(12, 3, 40, b'abc,def\n')
+    assert check_block(block) == (12, 3, 40, b'abc,def\n')
+
+
+def test_full_and_empty_payload():
+    full = bytes(range(256)) * 2
+    full = full[:journal.PAYLOAD_LEN]
+    assert check_block(make_block(1, 0, 0, full))[3] == full
+    assert check_block(make_block(1, 0, 1, b''))[3] == b''
+
+
+def test_corruption_is_detected():
+    block = make_block(1, 0, 5, b'x' * 100)
+    for i in (4, journal.CRC_OFFSET, journal.HEADER_LEN + 50):
+        bad = bytearray(block)
+        bad[i] ^= 0x01
+        assert check_block(bad) is None
+    assert check_block(block[:-1]) is None
+
+
+def test_scan_aligned():
+    blocks = [make_block(2, 1, seq, 'row {}\n'.format(seq).encode()) for seq in range(5)]
+    blocks[2][journal.HEADER_LEN + 1] ^= 0xFF
+    image = bytes(journal.BLOCK) + b''.join(blocks) + b'\xff' * journal.BLOCK
+
+    found = list(scan_journal(io.BytesIO(image), chunk=700))
+    assert [(b[0], b[3]) for b in found] == [(journal.BLOCK * (i + 1), i) for i in (0, 1, 3, 4)]
+    assert found[0][1:3] == (2, 1)
+
+
+def test_scan_unaligned():
+    block = make_block(3, 0, 9, b'payload')
+    image = b'MPSJ' + b'\0' * 37 + block + b'junk'
+    found = list(scan_journal(io.BytesIO(image), aligned=False, chunk=64))
+    assert [(b[0], b[3], b[4]) for b in found] == [(41, 9, b'payload')]
+    assert not list(scan_journal(io.BytesIO(image)))
+
+# ============= EOF =============================================
@@ -0,0 +1,110 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import io
+import struct
+
+import pytest
+# ============= local library imports  ==========================
+from mpsp.records import RecordEncoder, put_varint, file_header
+from mpsp_readers import RecordReader, get_varint
+
+
+def f32(v):
+    return struct.unpack('<f', struct.pack('<f', v))[0]
+
+
+def encode(records, keyframe):
+    enc = RecordEncoder(keyframe=keyframe)
+    out = bytearray(file_header())
+    for rec in records:
+        kind = rec[0]
+        if kind == 'schema':
+            out += enc.schema(*rec[1:])
+        elif kind == 'gps':
+            g = enc.gps(rec[1])
+            if g is not None:
+                out += g
+        else:
+            out += enc.sample(*rec[1:])
+    return bytes(out)
+
+
+def test_varint_round_trip():
+    values = [0, 1, -1, 63, -64, 64, -65, 8191, -8192, 2 ** 31 - 1, -2 ** 31, 10 ** 12, -10 ** 12]
+    buf = bytearray(16 * len(values))
+    i = 0
+    for v in values:
+        i = put_varint(buf, i, v)
+
+    read = io.BytesIO(bytes(buf[:i])).read
+    assert [get_varint(read) for _ in values] == values
+    assert get_varint(read) is None
+
+
+def test_truncated_varint():
+    buf = bytearray(8)
+    i = put_varint(buf, 0, 10 ** 6)
+    assert get_varint(io.BytesIO(bytes(buf[:i - 1])).read) is None
+
+
+def test_delta_round_trip():
+    records = [('schema', 2, 'dht', 'f', ['hum', 'temp']),
+               ('schema', 3, 'link', 'I', ['a', 'b', 'c'])]
+    expected = []
+    gps = None
+    for i in range(50):
+        if i % 3 == 0:
+            gps = (i * 200, 350000000 + i * 7, -1060000000 - i * 3, 1500000 + i, 10000 - i)
+            records.append(('gps', gps))
+            expected.append(('gps', gps))
+        v = (40 + i * 0.1, 21.5 - i * 0.03)
+        records.append(('sample', 2, i * 100, v))
+        expected.append(('sample', 2, i * 100, tuple(map(f32, v))))
+        u = (i, i * 1000, 7)
+        records.append(('sample', 3, i * 100 + 5, u))
+        expected.append(('sample', 3, i * 100 + 5, u))
+
+    plain = encode(records, 0)
+    delta = encode(records, 8)
+    assert len(delta) < len(plain)
+
+    for data in (plain, delta):
+        out = [r for r in RecordReader(io.BytesIO(data)) if r[0] != 'schema']
+        assert out == expected
+
+
+def test_unchanged_position_is_not_repeated():
+    gps = (1, 2, 3, 4, 5)
+    enc = RecordEncoder()
+    assert enc.gps(gps) is not None
+    assert enc.gps(gps) is None
+    assert enc.gps(gps, True) is not None
+
+
+def test_truncated_record_ends_iteration():
+    data = encode([('schema', 2, 'ds', 'f', ['t']), ('sample', 2, 5, (1.5,)), ('sample', 2, 6, (2.5,))], 0)
+    out = list(RecordReader(io.BytesIO(data[:-2])))
+    assert out[-1] == ('sample', 2, 5, (1.5,))
+
+
+def test_not_a_record_log():
+    with pytest.raises(ValueError):
+        list(RecordReader(io.BytesIO(b'time,value\n')))
+
+# ============= EOF =============================================
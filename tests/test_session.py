@@ -0,0 +1,63 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+# ============= local library imports  ==========================
+from mpsp.session import SessionIndex
+from mpsp_readers import read_index
+
+
+def test_session_index_round_trip(tmp_path):
+    path = str(tmp_path / 'index.bin')
+    idx = SessionIndex(path, first=7)
+    assert idx.begin(1000) == 7
+    idx.add_file('/sd/mpsp_data/dht/000007.bin', 10)
+    idx.add_file('/sd/mpsp_data/session/000007.bin', 12)
+    idx.add_file('/sd/mpsp_data/dht/000007.bin', 10, 4096)
+    idx.end(65000)
+
+    # reopened after a reboot, this flight never ends cleanly
+    idx = SessionIndex(path)
+    assert idx.begin(2000) == 8
+    idx.add_file('/sd/mpsp_data/dht/000008.bin', 5, 512)
+
+    with open(path, 'rb') as rfile:
+        nxt, sessions = read_index(rfile)
+
+    assert nxt == 9
+    assert sessions == [
+        {'number': 7, 'start': 1000, 'duration': 65000,
+         'files': [['/sd/mpsp_data/dht/000007.bin', 10, 4096], ['/sd/mpsp_data/session/000007.bin', 12, 0]]},
+        {'number': 8, 'start': 2000, 'duration': None,
+         'files': [['/sd/mpsp_data/dht/000008.bin', 5, 512]]}]
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    path = str(tmp_path / 'index.bin')
+    idx = SessionIndex(path)
+    idx.begin(1)
+    idx.end(10)
+    with open(path, 'rb') as rfile:
+        data = rfile.read()
+    with open(path, 'wb') as wfile:
+        wfile.write(data[:-3])
+
+    with open(path, 'rb') as rfile:
+        nxt, sessions = read_index(rfile)
+    assert sessions[0]['duration'] is None
+
+# ============= EOF =============================================
@@ -0,0 +1,368 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+host side throughput benchmark for mavlink.mavlink
+
+replays a recorded .tlog, a raw MAVLink capture or a synthetic stream through
+MAVLink.poll/get_messages under CPython, using a stand-in pyb.UART that hands
+the bytes out in FIFO sized chunks.
+
+    python tools/mavlink_bench.py --synthetic 20000 --chunk 64
+    python tools/mavlink_bench.py --tlog flight.tlog --chunk 16:128 --min-fps 20000
+
+exits with status 1 when a --min-fps or --max-alloc gate fails
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import argparse
+import builtins
+import os
+import random
+import struct
+import sys
+import time
+import tracemalloc
+import types
+
+# ============= local library imports  ==========================
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class BenchUART:
+    """
+    stand-in for pyb.UART. ``any`` reports at most one chunk at a time, the way
+    the hardware FIFO fills between two main loop passes
+    """
+
+    def __init__(self, *args, **kw):
+        self.data = b''
+        self.pos = 0
+        self.chunk = (64, 64)
+        self._ready = 0
+        self.written = 0
+
+    def load(self, data, chunk):
+        self.data = data
+        self.pos = 0
+        self.chunk = chunk
+        self._ready = 0
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+    def arrive(self):
+        """
+        make the next chunk available
+        """
+        lo, hi = self.chunk
+        n = lo if lo == hi else random.randint(lo, hi)
+        self._ready = min(self._ready + n, self.remaining())
+
+    def any(self):
+        return self._ready
+
+    def readinto(self, buf, n=None):
+        if n is None:
+            n = len(buf)
+        n = min(n, self._ready)
+        p = self.pos
+        buf[0:n] = self.data[p:p + n]
+        self.pos = p + n
+        self._ready -= n
+        return n
+
+    def readchar(self):
+        if not self._ready:
+            return -1
+        c = self.data[self.pos]
+        self.pos += 1
+        self._ready -= 1
+        return c
+
+    def write(self, buf):
+        self.written += len(buf)
+        return len(buf)
+
+
+class BenchVCP:
+    """
+    stand-in for pyb.USB_VCP, log lines go nowhere
+    """
+
+    def isconnected(self):
+        return False
+
+    def send(self, data, timeout=0):
+        return 0
+
+
+class BenchTimer:
+    def __init__(self, *args, **kw):
+        self.cb = None
+
+    def callback(self, cb):
+        self.cb = cb
+
+    def fire(self):
+        if self.cb:
+            self.cb(self)
+
+
+def install_stubs():
+    """
+    register stand-ins for the MicroPython modules mavlink.mavlink imports
+    """
+    t0 = time.perf_counter()
+
+    pyb = types.ModuleType('pyb')
+    pyb.UART = BenchUART
+    pyb.Timer = BenchTimer
+    pyb.millis = lambda: int((time.perf_counter() - t0) * 1000)
+    pyb.delay = lambda ms: None
+    pyb.disable_irq = lambda: 0
+    pyb.enable_irq = lambda state=0: None
+    pyb.USB_VCP = BenchVCP
+
+    utime = types.ModuleType('utime')
+    utime.ticks_us = lambda: int(time.perf_counter() * 1000000)
+    utime.ticks_diff = lambda a, b: a - b
+
+    sys.modules['pyb'] = pyb
+    sys.modules['utime'] = utime
+    builtins.const = lambda x: x
+
+
+def make_frame(mid, payload, seq, v2=False):
+    from mavlink import CRC_EXTRA
+    from mavlink.crc import x25_crc, x25_accumulate
+
+    if v2:
+        payload = payload.rstrip(b'\0') or b'\0'
+        f = bytearray((0xFD, len(payload), 0, 0, seq, 1, 1, mid & 0xFF, (mid >> 8) & 0xFF, mid >> 16))
+    else:
+        f = bytearray((0xFE, len(payload), seq, 1, 1, mid))
+    f += payload
+    crc = x25_accumulate(CRC_EXTRA[mid], x25_crc(f, 1, len(f)))
+    f += struct.pack('<H', crc)
+    return bytes(f)
+
+
+def synthetic_stream(nframes, v2_fraction=0.5, noise=0.0, seed=0):
+    """
+    a mix resembling an ArduPilot telemetry link: position, attitude, heartbeats
+    and messages we do not decode, optionally with bit flips and dropped frames
+    """
+    from mavlink import HEARTBEAT, GLOBAL_POSITION_INT, ATTITUDE, SYS_STATUS, VFR_HUD, RAW_IMU
+
+    rng = random.Random(seed)
+    mix = ((GLOBAL_POSITION_INT, 28, 0.3),
+           (ATTITUDE, 28, 0.3),
+           (VFR_HUD, 20, 0.15),
+           (RAW_IMU, 29, 0.15),
+           (SYS_STATUS, 43, 0.05),
+           (HEARTBEAT, 9, 0.05))
+
+    out = bytearray()
+    for seq in range(nframes):
+        r = rng.random()
+        for mid, n, p in mix:
+            r -= p
+            if r <= 0:
+                break
+
+        if mid == GLOBAL_POSITION_INT:
+            payload = struct.pack('<IiiiihhhH', seq * 100, 350000000 + seq, -1060000000 - seq,
+                                  1500000 + seq, 10000 + seq, 0, 0, 0, 0)
+        elif mid == ATTITUDE:
+            payload = struct.pack('<Iffffff', seq * 100, 0.1, -0.2, 1.5, 0, 0, 0)
+        elif mid == HEARTBEAT:
+            payload = struct.pack('<IBBBBB', 0, 2, 3, 81, 4, 3)
+        else:
+            payload = bytes(rng.getrandbits(8) for _ in range(n))
+
+        f = make_frame(mid, payload, seq & 0xFF, rng.random() < v2_fraction)
+        if noise and rng.random() < noise:
+            if rng.random() < 0.5:
+                # dropped on the wire
+                continue
+            f = bytearray(f)
+            f[rng.randrange(len(f))] ^= 1 << rng.randrange(8)
+        out += f
+    return bytes(out)
+
+
+def read_tlog(path):
+    """
+    strip the 8 byte timestamps from a MAVProxy/QGC .tlog. files that do not look
+    like a tlog are treated as a raw capture
+    """
+    with open(path, 'rb') as rfile:
+        raw = rfile.read()
+
+    out = bytearray()
+    i = 0
+    n = len(raw)
+    while i + 9 < n:
+        stx = raw[i + 8]
+        if stx == 0xFE:
+            end = i + 8 + raw[i + 9] + 8
+        elif stx == 0xFD:
+            end = i + 8 + raw[i + 9] + 12
+            if raw[i + 10] & 0x01:
+                end += 13
+        else:
+            break
+        out += raw[i + 8:end]
+        i = end
+
+    if not out:
+        return raw
+    return bytes(out)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def run(data, chunk, api='poll', irq=False, repeat=1, trace=True):
+    from mavlink.mavlink import MAVLink
+
+    link = MAVLink(irq_timer=1 if irq else None)
+    uart = link._uart
+    timer = link._receiver._timer if irq else None
+
+    nframes = 0
+    latencies = []
+    alloc = 0
+    elapsed = 0
+
+    if trace:
+        tracemalloc.start()
+
+    for _ in range(repeat):
+        uart.load(data, chunk)
+        while uart.remaining() or uart.any():
+            uart.arrive()
+            if timer:
+                timer.fire()
+
+            if trace:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+
+            st = time.perf_counter()
+            if api == 'poll':
+                msgs = link.poll(max_bytes=1 << 20, max_us=1 << 30)
+            else:
+                msgs = link.get_messages()
+            et = time.perf_counter() - st
+
+            if trace:
+                alloc += tracemalloc.get_traced_memory()[1] - before
+
+            elapsed += et
+            if msgs:
+                nframes += len(msgs)
+                latencies.append(et / len(msgs) * 1e6)
+
+        if timer:
+            # flush whatever the last interrupt left in the active buffer
+            timer.fire()
+            msgs = link.poll(max_bytes=1 << 20, max_us=1 << 30)
+            nframes += len(msgs)
+
+    if trace:
+        tracemalloc.stop()
+
+    stats = link.stats()
+    return {'frames': nframes,
+            'bytes': len(data) * repeat,
+            'elapsed': elapsed,
+            'fps': nframes / elapsed if elapsed else 0,
+            'alloc_per_frame': alloc / nframes if nframes else 0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else 0,
+            'received': stats[0],
+            'dropped': stats[1],
+            'crc_errors': stats[2],
+            'resyncs': stats[3],
+            'overruns': stats[4]}
+
+
+def parse_chunk(text):
+    if ':' in text:
+        lo, hi = text.split(':')
+        return int(lo), int(hi)
+    n = int(text)
+    return n, n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    src = parser.add_mutually_exclusive_group()
+    src.add_argument('--tlog', help='recorded .tlog or raw MAVLink capture')
+    src.add_argument('--synthetic', type=int, default=20000, help='number of synthetic frames')
+    parser.add_argument('--v2', type=float, default=0.5, help='fraction of synthetic frames sent as v2')
+    parser.add_argument('--noise', type=float, default=0.0, help='fraction of synthetic frames corrupted')
+    parser.add_argument('--chunk', default='64', help='bytes per UART read, N or MIN:MAX')
+    parser.add_argument('--api', choices=('poll', 'get_messages'), default='poll')
+    parser.add_argument('--irq', action='store_true', help='receive through the interrupt double buffer')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-trace', action='store_true', help='skip tracemalloc, for clean timings')
+    parser.add_argument('--min-fps', type=float, help='fail if frames/s drops below this')
+    parser.add_argument('--max-alloc', type=float, help='fail if bytes allocated per frame exceed this')
+    args = parser.parse_args(argv)
+
+    install_stubs()
+    random.seed(0)
+
+    if args.tlog:
+        data = read_tlog(args.tlog)
+    else:
+        data = synthetic_stream(args.synthetic, args.v2, args.noise)
+
+    r = run(data, parse_chunk(args.chunk), args.api, args.irq, args.repeat, not args.no_trace)
+
+    print('frames           {frames}'.format(**r))
+    print('bytes            {bytes}'.format(**r))
+    print('frames/s         {fps:0.0f}'.format(**r))
+    print('bytes/s          {:0.0f}'.format(r['bytes'] / r['elapsed'] if r['elapsed'] else 0))
+    if not args.no_trace:
+        print('alloc bytes/frame {alloc_per_frame:0.1f}'.format(**r))
+    print('latency us/frame p50={p50:0.2f} p90={p90:0.2f} p99={p99:0.2f} max={max:0.2f}'.format(**r))
+    print('link received={received} dropped={dropped} crc_errors={crc_errors} '
+          'resyncs={resyncs} overruns={overruns}'.format(**r))
+
+    failed = False
+    if args.min_fps is not None and r['fps'] < args.min_fps:
+        print('FAIL frames/s {:0.0f} < {}'.format(r['fps'], args.min_fps))
+        failed = True
+    if args.max_alloc is not None and r['alloc_per_frame'] > args.max_alloc:
+        print('FAIL alloc bytes/frame {:0.1f} > {}'.format(r['alloc_per_frame'], args.max_alloc))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+# ============= EOF =============================================
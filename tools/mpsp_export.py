@@ -0,0 +1,307 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+host side tools for MPSP binary data logs
+
+    python tools/mpsp_export.py csv /Volumes/NO\\ NAME/mpsp_data/dht/000012.bin -o dht.csv
+    python tools/mpsp_export.py demux /Volumes/NO\\ NAME/mpsp_data/session/000003.bin -o flight3
+    python tools/mpsp_export.py sessions /Volumes/NO\\ NAME/mpsp_data/index.bin
+    python tools/mpsp_export.py recover /dev/rdisk4 -o recovered
+
+csv and demux read journaled logs ("journal": true) as well as plain ones
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import argparse
+import datetime
+import io
+import os
+import sys
+
+# ============= local library imports  ==========================
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mpsp.records import GPS_FIELDS  # noqa: E402
+from mpsp.records import MAGIC as RECORDS_MAGIC, file_header  # noqa: E402
+from mpsp_readers import RecordReader, read_index, scan_journal  # noqa: E402
+
+# MicroPython's utime.time() counts from 2000-01-01
+EPOCH = datetime.datetime(2000, 1, 1)
+
+NO_GPS = ('',) * len(GPS_FIELDS)
+
+
+def fmt_value(v):
+    if isinstance(v, float):
+        # values are stored as float32, 7 significant digits round trip
+        return '{:.7g}'.format(v)
+    return str(v)
+
+
+def fmt_row(t, gps, values):
+    row = [str(t)]
+    row.extend(map(str, gps))
+    row.extend(fmt_value(v) for v in values)
+    return ','.join(row)
+
+
+def export_csv(src, out):
+    """
+    stream the records in src to out as csv. a header row is written whenever a
+    device schema is declared or changes, not where a journal block repeats it
+    """
+    reader = RecordReader(src)
+    gps = NO_GPS
+    nrows = 0
+    declared = {}
+    for rec in reader:
+        kind = rec[0]
+        if kind == 'sample':
+            out.write(fmt_row(rec[2], gps, rec[3]))
+            out.write('\n')
+            nrows += 1
+        elif kind == 'gps':
+            gps = rec[1]
+        else:
+            _, tag, name, fields = rec
+            if declared.get(tag) != (name, fields):
+                declared[tag] = (name, fields)
+                out.write(','.join(('MS',) + GPS_FIELDS + fields))
+                out.write('\n')
+    return nrows
+
+
+def demux(src, outdir):
+    """
+    split a multiplexed session log into one csv per device tag. returns
+    {path: rows}. each row carries the position that was current when the
+    sample was taken, whichever device's record it was written ahead of
+    """
+    reader = RecordReader(src)
+    gps = NO_GPS
+    outs = {}
+    counts = {}
+    declared = {}
+    try:
+        for rec in reader:
+            kind = rec[0]
+            if kind == 'sample':
+                tag = rec[1]
+                outs[tag].write(fmt_row(rec[2], gps, rec[3]))
+                outs[tag].write('\n')
+                counts[tag] += 1
+            elif kind == 'gps':
+                gps = rec[1]
+            else:
+                _, tag, name, fields = rec
+                if declared.get(tag) == fields:
+                    # repeated at the start of a journal block
+                    continue
+                declared[tag] = fields
+                out = outs.get(tag)
+                if out is None:
+                    path = os.path.join(outdir, '{}_{}.csv'.format(name, tag))
+                    out = open(path, 'w')
+                    outs[tag] = out
+                    counts[tag] = 0
+                out.write(','.join(('MS',) + GPS_FIELDS + fields))
+                out.write('\n')
+    finally:
+        for out in outs.values():
+            out.close()
+
+    return {outs[tag].name: counts[tag] for tag in outs}
+
+
+def assemble(blocks):
+    """
+    group intact journal blocks by (session, stream) and put them back in order.
+    returns {(session, stream): (parts, missing)}. a new part starts wherever a
+    segment restarts with a file header, missing is the number of lost blocks.
+    a stream's blocks are numbered from 0 across all its segments, lost leading
+    blocks are counted from 0 unless the first intact block opens a segment
+    """
+    streams = {}
+    for offset, session, stream, seq, payload in blocks:
+        # a sector may survive in several places, e.g. in a card image, keep the first
+        streams.setdefault((session, stream), {}).setdefault(seq, payload)
+
+    out = {}
+    for key, blks in streams.items():
+        seqs = sorted(blks)
+        first = seqs[0] if blks[seqs[0]].startswith(RECORDS_MAGIC) else 0
+        missing = seqs[-1] - first + 1 - len(seqs)
+        parts = []
+        cur = None
+        for seq in seqs:
+            payload = blks[seq]
+            if cur is None or payload.startswith(RECORDS_MAGIC):
+                cur = bytearray()
+                parts.append(cur)
+            cur += payload
+        out[key] = (parts, missing)
+    return out
+
+
+def open_log(path):
+    """
+    binary stream of the records in path, unwrapping a journaled log. only the
+    blocks of the session and stream of the file's first block are kept, a
+    preallocated segment may end in intact blocks left on the card by an
+    earlier flight
+    """
+    src = open(path, 'rb')
+    if src.read(len(RECORDS_MAGIC)) == RECORDS_MAGIC:
+        # not journaled. a journaled log is scanned even if its first block is lost
+        src.seek(0)
+        return src
+
+    src.seek(0)
+    with src:
+        blocks = list(scan_journal(src))
+    data = bytearray()
+    if blocks:
+        key = blocks[0][1:3]
+        streams = assemble(b for b in blocks if b[1:3] == key)
+        for part in streams[key][0]:
+            data += part
+        if not data.startswith(RECORDS_MAGIC) and data[0] < 0x20:
+            # the block holding the file header was lost, the blocks after it
+            # still decode on their own
+            data[0:0] = file_header()
+    return io.BytesIO(bytes(data))
+
+
+def open_out(path):
+    if path is None or path == '-':
+        return sys.stdout
+    return open(path, 'w')
+
+
+def cmd_csv(args):
+    out = open_out(args.output)
+    with open_log(args.path) as src:
+        n = export_csv(src, out)
+    if out is not sys.stdout:
+        out.close()
+    print('{} rows'.format(n), file=sys.stderr)
+
+
+def cmd_demux(args):
+    outdir = args.output or os.path.splitext(args.path)[0]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    with open_log(args.path) as src:
+        counts = demux(src, outdir)
+    for path in sorted(counts):
+        print('{} {} rows'.format(path, counts[path]), file=sys.stderr)
+
+
+def fmt_start(start):
+    return (EPOCH + datetime.timedelta(seconds=start)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def fmt_duration(ms):
+    if ms is None:
+        return 'unclosed'
+    return '{:d}:{:02d}'.format(ms // 60000, ms // 1000 % 60)
+
+
+def cmd_sessions(args):
+    with open(args.path, 'rb') as src:
+        nxt, sessions = read_index(src)
+
+    if args.session is not None:
+        sessions = [s for s in sessions if s['number'] == args.session]
+
+    for s in sessions:
+        total = sum(f[2] for f in s['files'])
+        print('{:06d}  {}  {:>8s}  {:3d} files  {:10d} bytes'.format(s['number'], fmt_start(s['start']),
+                                                                      fmt_duration(s['duration']),
+                                                                      len(s['files']), total))
+        if args.files:
+            for path, opened, size in s['files']:
+                print('        {:>8d}ms  {:10d}  {}'.format(opened, size, path))
+    print('next session {}'.format(nxt), file=sys.stderr)
+
+
+def cmd_recover(args):
+    """
+    pull every intact journal block out of a damaged log or a raw card image
+    """
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    with open(args.path, 'rb') as src:
+        streams = assemble(scan_journal(src, aligned=not args.unaligned))
+
+    if not streams:
+        print('no journal blocks found', file=sys.stderr)
+        return
+
+    for (session, stream), (parts, missing) in sorted(streams.items()):
+        # csv text never starts with a control character, record tags do
+        binary = any(p.startswith(RECORDS_MAGIC) for p in parts) or parts[0][0] < 0x20
+        for i, part in enumerate(parts):
+            if binary and not part.startswith(RECORDS_MAGIC):
+                # the block holding the file header was lost
+                part = file_header() + part
+
+            name = '{:06d}_{:02d}_{:03d}.{}'.format(session, stream, i, 'bin' if binary else 'csv')
+            with open(os.path.join(args.output, name), 'wb') as wfile:
+                wfile.write(part)
+            print('{} {} bytes'.format(name, len(part)), file=sys.stderr)
+        if missing:
+            print('session {} stream {}: {} blocks missing'.format(session, stream, missing), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('csv', help='convert a binary log to csv')
+    p.add_argument('path')
+    p.add_argument('-o', '--output', help='csv file, default stdout')
+    p.set_defaults(func=cmd_csv)
+
+    p = sub.add_parser('demux', help='split a session log into one csv per device')
+    p.add_argument('path')
+    p.add_argument('-o', '--output', help='output directory, default next to the log')
+    p.set_defaults(func=cmd_demux)
+
+    p = sub.add_parser('sessions', help='list the flights recorded in a session index')
+    p.add_argument('path', help='DATA_ROOT/index.bin')
+    p.add_argument('-s', '--session', type=int, help='only this session')
+    p.add_argument('-f', '--files', action='store_true', help='list each session\'s files')
+    p.set_defaults(func=cmd_sessions)
+
+    p = sub.add_parser('recover', help='extract intact journal blocks from a damaged log or card image')
+    p.add_argument('path', help='journaled log, raw card image or block device')
+    p.add_argument('-o', '--output', default='recovered', help='output directory')
+    p.add_argument('--unaligned', action='store_true',
+                   help='look for blocks at every offset, not only on sector boundaries')
+    p.set_defaults(func=cmd_recover)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
+# ============= EOF =============================================
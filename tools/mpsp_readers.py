@@ -0,0 +1,274 @@
+# ===============================================================================
+# Copyright 2017 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+host side readers for the files the board writes: binary record logs
+(mpsp.records), journal blocks (mpsp.journal) and the session index
+(mpsp.session). kept out of the mpsp package so they are not copied to the
+board, where only the writers are needed
+"""
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import os
+import struct
+import sys
+# ============= local library imports  ==========================
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mpsp import journal, session as index  # noqa: E402
+from mpsp.records import MAGIC, TAG_SCHEMA, TAG_GPS, TAG_GPS_DELTA, FIRST_DEVICE_TAG, SCHEMA_FORMAT, SCHEMA_LEN, \
+    GPS_FORMAT, GPS_LEN, DELTA, sample_format, delta_format  # noqa: E402
+
+
+def get_varint(read):
+    """
+    read one zigzag varint with read(1). None at the end of the stream
+    """
+    v = 0
+    shift = 0
+    while 1:
+        b = read(1)
+        if not b:
+            return
+        b = b[0]
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return (v >> 1) if not v & 1 else -((v + 1) >> 1)
+
+class RecordReader:
+    """
+    streams records back out of a file like object. iterating yields
+
+        ('schema', tag, name, fields)
+        ('gps', (GPS_BOOT_TIME, LAT, LON, ALT, REL_ALT))
+        ('sample', tag, millis, values)
+
+    delta records are expanded, so they read exactly like full ones. a truncated
+    trailing record or the zero fill of a preallocated segment ends the iteration
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._layouts = {}
+
+    def __iter__(self):
+        read = self._stream.read
+        head = read(len(MAGIC) + 1)
+        if head[:len(MAGIC)] != MAGIC:
+            raise ValueError('not an MPSP binary log')
+
+        layouts = self._layouts
+        # tag -> previous record, the base of the next delta
+        last = {}
+        while 1:
+            tag = read(1)
+            if not tag:
+                return
+            t = tag[0]
+            if t == TAG_SCHEMA:
+                rest = read(SCHEMA_LEN - 1)
+                if len(rest) < SCHEMA_LEN - 1:
+                    return
+                _, dtag, n = struct.unpack(SCHEMA_FORMAT, tag + rest)
+                if dtag < FIRST_DEVICE_TAG:
+                    # zeros past the end of the data
+                    return
+                body = read(n)
+                if len(body) < n:
+                    return
+                name, code, fields = body.decode().split('\t')
+                fields = tuple(fields.split(','))
+                fmt = sample_format(code, len(fields))
+                dfmt = delta_format(code, len(fields))
+                layouts[dtag] = (struct.Struct(fmt), name, fields, dfmt and struct.Struct(dfmt),
+                                 struct.Struct('<' + code * len(fields)) if code == 'f' else None)
+                last.pop(dtag, None)
+                yield 'schema', dtag, name, fields
+            elif t == TAG_GPS:
+                rest = read(GPS_LEN - 1)
+                if len(rest) < GPS_LEN - 1:
+                    return
+                g = struct.unpack(GPS_FORMAT, tag + rest)[1:]
+                last[TAG_GPS] = g
+                yield 'gps', g
+            elif t == TAG_GPS_DELTA:
+                lv = last.get(TAG_GPS)
+                if lv is None:
+                    raise ValueError('position delta without a base')
+                g = []
+                for v in lv:
+                    d = get_varint(read)
+                    if d is None:
+                        return
+                    g.append(v + d)
+                g = tuple(g)
+                last[TAG_GPS] = g
+                yield 'gps', g
+            elif t & DELTA:
+                dtag = t & ~DELTA
+                try:
+                    fs = layouts[dtag][4]
+                    lt, lv = last[dtag]
+                except KeyError:
+                    raise ValueError('sample delta for tag {} without a base'.format(dtag))
+                d = get_varint(read)
+                if d is None:
+                    return
+                lt += d
+                vs = []
+                for v in lv:
+                    d = get_varint(read)
+                    if d is None:
+                        return
+                    vs.append(v + d)
+                last[dtag] = (lt, vs)
+                if fs is not None:
+                    # back from bit patterns to float32
+                    vs = fs.unpack(struct.pack('<{}i'.format(len(vs)), *vs))
+                yield 'sample', dtag, lt, tuple(vs)
+            else:
+                try:
+                    s, _, _, ds, fs = layouts[t]
+                except KeyError:
+                    raise ValueError('sample for undeclared tag {}'.format(t))
+                rest = read(s.size - 1)
+                if len(rest) < s.size - 1:
+                    return
+                raw = tag + rest
+                r = s.unpack(raw)
+                if ds is not None:
+                    last[t] = (r[1], ds.unpack(raw)[2:])
+                yield 'sample', t, r[1], r[2:]
+
+    def layout(self, tag):
+        """
+        (name, fields) declared for tag
+        """
+        return self._layouts[tag][1:3]
+
+
+def check_block(block):
+    """
+    (session, stream, seq, payload) or None if block is not an intact journal block
+    """
+    if len(block) < journal.BLOCK or block[:4] != journal.MAGIC:
+        return
+
+    _, session, stream, n, seq, crc = struct.unpack_from(journal.HEADER_FORMAT, block, 0)
+    if n > journal.PAYLOAD_LEN or crc != journal.block_crc(block, n):
+        return
+    return session, stream, seq, bytes(block[journal.HEADER_LEN:journal.HEADER_LEN + n])
+
+
+def scan_journal(stream, aligned=True, chunk=1 << 20):
+    """
+    yield (offset, session, stream, seq, payload) for every intact block in a file
+    or raw card image. with aligned only sector boundaries are tried, otherwise
+    every occurrence of MAGIC is
+    """
+    read = stream.read
+    base = 0
+    buf = b''
+    while 1:
+        data = read(chunk)
+        if data:
+            buf += data
+        elif len(buf) < journal.BLOCK:
+            return
+
+        i = 0
+        end = len(buf) - journal.BLOCK
+        while i <= end:
+            if aligned:
+                r = check_block(buf[i:i + journal.BLOCK])
+                if r is not None:
+                    yield (base + i,) + r
+                i += journal.BLOCK
+            else:
+                i = buf.find(journal.MAGIC, i, end + 4)
+                if i < 0:
+                    i = end + 1
+                    break
+                r = check_block(buf[i:i + journal.BLOCK])
+                if r is not None:
+                    yield (base + i,) + r
+                    i += journal.BLOCK
+                else:
+                    i += 1
+
+        if not data:
+            return
+
+        buf = buf[i:]
+        base += i
+
+
+def read_index(stream):
+    """
+    returns (next session number, sessions) from a session index. each session is
+    a dict with number, start, duration (None if the session never ended cleanly)
+    and files, a list of [path, opened, size] in the order they were opened
+    """
+    magic, version, nxt = struct.unpack(index.HEADER_FORMAT, stream.read(index.HEADER_LEN))
+    if magic != index.MAGIC:
+        raise ValueError('not an MPSP session index')
+
+    sessions = {}
+    order = []
+    read = stream.read
+    while 1:
+        kind = read(1)
+        if not kind:
+            break
+
+        k = kind[0]
+        if k == index.REC_SESSION:
+            rest = read(index.SESSION_LEN - 1)
+            if len(rest) < index.SESSION_LEN - 1:
+                break
+            _, n, start = struct.unpack(index.SESSION_FORMAT, kind + rest)
+            sessions[n] = {'number': n, 'start': start, 'duration': None, 'files': []}
+            order.append(n)
+        elif k == index.REC_FILE:
+            rest = read(index.FILE_LEN - 1)
+            if len(rest) < index.FILE_LEN - 1:
+                break
+            _, n, opened, size, plen = struct.unpack(index.FILE_FORMAT, kind + rest)
+            path = read(plen)
+            if len(path) < plen:
+                break
+            path = path.decode()
+            files = sessions[n]['files']
+            for f in files:
+                if f[0] == path:
+                    f[2] = size
+                    break
+            else:
+                files.append([path, opened, size])
+        elif k == index.REC_END:
+            rest = read(index.END_LEN - 1)
+            if len(rest) < index.END_LEN - 1:
+                break
+            _, n, duration = struct.unpack(index.END_FORMAT, kind + rest)
+            sessions[n]['duration'] = duration
+        else:
+            raise ValueError('bad index record kind {}'.format(k))
+
+    return nxt, [sessions[n] for n in order]
+
+# ============= EOF =============================================